@@ -1,3 +1,6 @@
+import sys
+sys.path.insert(0, '/users/fs2/hmehri/pythonproject/Thesis/synthetic')
+
 from myctgan import CTGAN
 from data_transformer import DataTransformer
 from data_sampler import DataSampler
@@ -14,6 +17,7 @@ import os
 import random
 
 from prepare_data import preprocess_data_czech
+from lib.data_cache import load_preprocessed
 # Set seeds
 # random.seed(0)
 # np.random.seed(0)
@@ -465,9 +469,8 @@ def main():
     """ The order of columns is important, 'tcode' should be the first discrete column"""
     with tf.device('/gpu:0'):
 
-        df = pd.read_csv('../DATA/tr_by_acct_w_age.csv')
         print('preprocessing data....')
-        raw_data, LOG_AMOUNT_SCALE, TD_SCALE = preprocess_data_czech(df)
+        raw_data, LOG_AMOUNT_SCALE, TD_SCALE = load_preprocessed('../DATA/tr_by_acct_w_age.csv', preprocess_data_czech)
         raw = raw_data.copy()
 
         final_raw = raw[['log_amount_sc', 'tcode', 'td', 'day', 'dow', 'dtme', 'month']]
@@ -1,12 +1,11 @@
 
-from datetime import datetime
-import calendar
 import numpy as np
 import pandas as pd
 import random
 import os
 import numpy as np
 import tensorflow as tf
+from lib.calendar_index import days_till_month_end
 
 # Set seeds
 random.seed(0)
@@ -14,13 +13,16 @@ np.random.seed(0)
 tf.random.set_seed(0)
 os.environ['TF_DETERMINISTIC_OPS'] = '1'
 
+# bump when the output of preprocess_data_czech() changes, invalidates entries of lib.data_cache
+PREPROCESS_VERSION = 2
+
 
 def preprocess_data_czech(df):
     #df = pd.read_csv('tr_by_acct_w_age.csv')
 
-    czech_date_parser = lambda x: datetime.strptime(str(x), "%y%m%d")
-    df["datetime"] = df["date"].apply(czech_date_parser)
-    #df["datetime"] = pd.to_datetime(df["datetime"])
+    # parse every distinct date once and broadcast it back to the rows
+    date_codes, dates = pd.factorize(df["date"])
+    df["datetime"] = pd.to_datetime(pd.Series(dates).astype(str), format="%y%m%d").to_numpy()[date_codes]
 
     df["month"] = df["datetime"].dt.month 
     df["day"] = df["datetime"].dt.day 
@@ -28,15 +30,14 @@ def preprocess_data_czech(df):
     df["year"] = df["datetime"].dt.year
     df["doy"] = df["datetime"].dt.dayofyear
     
-    df["td"] = df[["account_id", "datetime"]].groupby("account_id").diff()
-    df["td"] = df["td"].apply(lambda x: x.days)
-    df["td"].fillna(0.0, inplace=True)
+    df["td"] = df.groupby("account_id")["datetime"].diff().dt.days
+    df["td"] = df["td"].fillna(0.0)
     
 
     # dtme - days till month end
-    df["dtme"] = df.datetime.apply(lambda dt: calendar.monthrange(dt.year, dt.month)[1] - dt.day)
+    df["dtme"] = days_till_month_end(df["datetime"])
 
-    df['raw_amount'] = df.apply(lambda row: row['amount'] if row['type'] == 'CREDIT' else -row['amount'], axis=1)
+    df['raw_amount'] = np.where(df['type'] == 'CREDIT', df['amount'], -df['amount'])
 
 
     cat_code_fields = ['type', 'operation', 'k_symbol']
@@ -15,6 +15,7 @@ from calendar import monthrange
 from scipy.stats import norm
 from tensorflow_privacy.privacy.optimizers.dp_optimizer_keras import DPKerasAdamOptimizer
 import pickle
+from lib.calendar_index import calendar_table, calendar_dates
 import random
 import os
 import numpy as np
@@ -485,13 +486,10 @@ class Train(object):
         for column_info in self._transformer._column_transform_info_list:
             if column_info.column_name == 'tcode':
                ohe = column_info.transform
-        get_dtme = lambda d: calendar.monthrange(d.year, d.month)[1] - d.day
         START_DATE = raw_data['datetime'].min()
         MAX_YEARS_SPAN = 25
-        END_DATE = START_DATE.replace(year = START_DATE.year+ MAX_YEARS_SPAN)
-        ALL_DATES = [START_DATE + datetime.timedelta(i) for i in range((END_DATE - START_DATE).days)]
-        #AD = np.array([(d.month % 12, d.day % 31, d.weekday() % 7, i, d.year, get_dtme(d)) for i, d in enumerate(ALL_DATES)])
-        AD = np.array([(d.month -1, d.day -1, d.weekday() -1, i, d.year, get_dtme(d)) for i, d in enumerate(ALL_DATES)])
+        ALL_DATES = calendar_dates(START_DATE, MAX_YEARS_SPAN)
+        AD = calendar_table(START_DATE, MAX_YEARS_SPAN, convention="offset")
         max_days = 100
         #construct list of starting indexes
         # start_dates = raw_data.groupby('account_id')['datetime'].min()
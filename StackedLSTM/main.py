@@ -2,14 +2,17 @@ import sys
 sys.path.insert(0, '/users/fs2/hmehri/pythonproject/Thesis/synthetic')
 
 from lib.prepare_data import preprocess_data_czech
+from lib.data_cache import load_preprocessed, load_encoded
+from lib.memory import memory_report
+from lib.shards import export_shards, read_shard_meta, shard_dataset
 from lib.field_info import FieldInfo, FIELD_INFO_TCODE, FieldInfo_type2
 from lib.tensor_encoder import TensorEncoder
 import pandas as pd
 import tensorflow as tf
 import numpy as np
 from sklearn.model_selection import train_test_split
-from lib.modules import Encoder_Decoder_lstm
-from trainlstm import Train
+from lib.modules import Encoder_Decoder_lstm, FeatureEncoding
+from trainlstm import Train, use_field_info
 import json
 import random
 import os
@@ -39,35 +42,77 @@ def make_batches(ds, buffer_size, batch_size):
 def create_tensor_dataset(encoder,bs, split=True):
     """bs is Batch Size
        if split=True, the input data is split into train and validation, otherwise the whole data is used for training """
-    n_seqs, _, _ = encoder.inp_tensor.shape
+    # the encoder allocates float32 tensors, so no copy is made here unless they are stored as float16
+    inp_tensor = np.asarray(encoder.inp_tensor, dtype=np.float32)
+    tar_tensor = np.asarray(encoder.tar_tensor, dtype=np.float32)
+    n_seqs, _, _ = inp_tensor.shape
+    BUFFER_SIZE = n_seqs
 
-    x_tr, x_cv, inds_tr, inds_cv, targ_tr, targ_cv = train_test_split(encoder.inp_tensor, np.arange(n_seqs), encoder.tar_tensor, test_size=0.2)
+    # only the datasets that are returned are created, each of them holds a copy of its tensors
+    if not split:
+        ds_all = tf.data.Dataset.from_tensor_slices((inp_tensor, tar_tensor))
+        return make_batches(ds_all, BUFFER_SIZE, bs)
 
-    # Create TensorFlow dataset
-    ds_all = tf.data.Dataset.from_tensor_slices((encoder.inp_tensor.astype(np.float32), encoder.tar_tensor.astype(np.float32)))
-    ds_tr = tf.data.Dataset.from_tensor_slices((x_tr.astype(np.float32), targ_tr.astype(np.float32)))
-    ds_cv = tf.data.Dataset.from_tensor_slices((x_cv.astype(np.float32), targ_cv.astype(np.float32)))
+    x_tr, x_cv, inds_tr, inds_cv, targ_tr, targ_cv = train_test_split(inp_tensor, np.arange(n_seqs), tar_tensor, test_size=0.2)
 
-    BUFFER_SIZE = ds_all.cardinality().numpy()
+    ds_tr = tf.data.Dataset.from_tensor_slices((x_tr, targ_tr))
+    ds_cv = tf.data.Dataset.from_tensor_slices((x_cv, targ_cv))
 
-    all_batches =   make_batches(ds_all, BUFFER_SIZE, bs)
     train_batches = make_batches(ds_tr, BUFFER_SIZE, bs)
     val_batches =  make_batches(ds_cv, BUFFER_SIZE, bs)
-
-    if split:
-        return train_batches, val_batches
-    else:
-        return all_batches
+    return train_batches, val_batches
+
+
+def create_window_dataset(encoder, bs, split=True):
+    """as create_tensor_dataset(), for an encoder run with lazy=True: the windows are gathered from the per-transaction
+       encodings on the fly and train/validation are split by window index, so no windows are copied"""
+    n_seqs = len(encoder.window_starts)
+    if not split:
+        return encoder.window_batches(np.arange(n_seqs), bs, drop_remainder=True)
+
+    inds_tr, inds_cv = train_test_split(np.arange(n_seqs), test_size=0.2)
+    train_batches = encoder.window_batches(inds_tr, bs, drop_remainder=True)
+    val_batches = encoder.window_batches(inds_cv, bs, drop_remainder=True)
+    return train_batches, val_batches
+
+
+def create_raw_dataset(encoder, bs, split=True):
+    """as create_tensor_dataset(), for an encoder run with raw=True: the batches are (raw, lengths, attributes) of the
+       windows and are encoded by lib.modules.FeatureEncoding in the training step"""
+    raw_tensor = np.asarray(encoder.raw_tensor)
+    lengths = np.asarray(encoder.window_lengths, dtype=np.int32)
+    attributes = np.asarray(encoder.attributes, dtype=encoder.dtype)
+    n_seqs = len(raw_tensor)
+    if not split:
+        ds_all = tf.data.Dataset.from_tensor_slices((raw_tensor, lengths, attributes))
+        return make_batches(ds_all, n_seqs, bs)
+
+    inds_tr, inds_cv = train_test_split(np.arange(n_seqs), test_size=0.2)
+    ds_tr = tf.data.Dataset.from_tensor_slices((raw_tensor[inds_tr], lengths[inds_tr], attributes[inds_tr]))
+    ds_cv = tf.data.Dataset.from_tensor_slices((raw_tensor[inds_cv], lengths[inds_cv], attributes[inds_cv]))
+    train_batches = make_batches(ds_tr, n_seqs, bs)
+    val_batches = make_batches(ds_cv, n_seqs, bs)
+    return train_batches, val_batches
+
+
+def create_shard_dataset(encoder, bs, shard_dir):
+    """as create_tensor_dataset(), streamed from the TFRecord shards in shard_dir. The windows of the encoder are
+       exported (and split into train/validation) on the first run only, delete shard_dir to export them again"""
+    if read_shard_meta(shard_dir) is None:
+        export_shards(encoder, shard_dir, val_fraction=0.2)
+    train_batches = shard_dataset(shard_dir, "train", bs, drop_remainder=True)
+    val_batches = shard_dataset(shard_dir, "val", bs, drop_remainder=True)
+    return train_batches, val_batches
 
 
 def main():
     with tf.device('/gpu:0'):
-        raw_data = pd.read_csv('../DATA/tr_by_acct_w_age.csv')
-        data, LOG_AMOUNT_SCALE, TD_SCALE,ATTR_SCALE, START_DATE, _ = preprocess_data_czech(raw_data)
+        data, LOG_AMOUNT_SCALE, TD_SCALE,ATTR_SCALE, START_DATE, field_mappings = load_preprocessed('../DATA/tr_by_acct_w_age.csv', compact=True)
         data2 = data[['account_id','age','age_sc', 'tcode', 'tcode_num', 'datetime', 'month', 'dow', 'day','td', 'dtme', 'log_amount','log_amount_sc','td_sc',
                                    'type','operation', 'k_symbol', 'type_num', 'operation_num', 'k_symbol_num']]
         #data2 =  data[['account_id', 'tcode_num', 'age_sc', 'tcode', 'age']]
         df= data2.copy()
+        memory_report("preprocess", df=df)
 
         confighyper = load_config('config_hyper.json')
         max_seq_len = confighyper['max_seq_len']
@@ -79,19 +124,43 @@ def main():
         num_generated_seq = confighyper['num_generated_seq'] 
         synth_data_filename = confighyper["synth_data_filename"]
         strategy = confighyper['strategy']
-
-        info = FieldInfo(strategy)
-        #info = FIELD_INFO_TCODE()
-        #info = FieldInfo_type2()
+        lazy_windows = confighyper.get('lazy_windows', False)   # gather the windows on the fly instead of materializing them
+        shard_dir = confighyper.get('shard_dir')   # stream the windows from TFRecord shards written there on the first run
+        raw_windows = confighyper.get('raw_windows', False)   # store raw columns, the windows are encoded in the training graph
+        embed_fields = confighyper.get('embed_fields', [])   # categorical fields given to the models as embedded indices
+        embedding_dim = confighyper.get('embedding_dim', 16)
+        sampled_softmax = confighyper.get('sampled_softmax', {})   # field -> sampled classes of its softmax head while training
+        jit_compile = confighyper.get('jit_compile', False)   # compile the training steps with XLA
+        loss_weights = confighyper.get('loss_weights', 'default')   # name of a weight set of LOSS_WEIGHT_SETS of the trainer
+        generate_in_graph = confighyper.get('generate_in_graph', False)   # run the generation loop as one graph function
+
+        info = FieldInfo(strategy, field_mappings, embed_fields, embedding_dim)
+        use_field_info(info)
+        #info = FIELD_INFO_TCODE(field_mappings, embed_fields, embedding_dim)
+        #info = FieldInfo_type2(field_mappings, embed_fields, embedding_dim)
 
         
         encoder = TensorEncoder(df, info, max_seq_len, min_seq_len)
-        encoder.encode_with_overlap(slide_step=80)
-
-        n_seqs, seq_len, n_feat_inp = encoder.inp_tensor.shape
-        raw_features = encoder.tar_tensor.shape[-1]    #7
-
-        train_batches, val_batches = create_tensor_dataset(encoder, batch_size, split=True)
+        load_encoded(encoder, '../DATA/encoded_cache', 'encode_with_overlap', slide_step=80, lazy=lazy_windows, raw=raw_windows)
+        if raw_windows:
+            memory_report("encode", raw_tensor=encoder.raw_tensor)
+        elif lazy_windows:
+            memory_report("encode", inp_flat=encoder.inp_flat, tar_flat=encoder.tar_flat)
+        else:
+            memory_report("encode", inp_tensor=encoder.inp_tensor, tar_tensor=encoder.tar_tensor)
+
+        n_feat_inp = encoder.n_feat_inp
+        raw_features = encoder.n_feat_tar    #7
+
+        if raw_windows:
+            train_batches, val_batches = create_raw_dataset(encoder, batch_size, split=True)
+        elif shard_dir:
+            train_batches, val_batches = create_shard_dataset(encoder, batch_size, shard_dir)
+        elif lazy_windows:
+            train_batches, val_batches = create_window_dataset(encoder, batch_size, split=True)
+        else:
+            train_batches, val_batches = create_tensor_dataset(encoder, batch_size, split=True)
+        memory_report("dataset")
 
     
     
@@ -102,9 +171,11 @@ def main():
         config["FIELD_STARTS_NET"] = info.FIELD_STARTS_NET
         config["FIELD_DIMS_NET"] = info.FIELD_DIMS_NET
         config["ACTIVATIONS"] = info.ACTIVATIONS
+        config["EMBEDDINGS"] = getattr(info, "EMBEDDINGS", {})
+        config["SAMPLED_SOFTMAX"] = sampled_softmax
 
         lstm = Encoder_Decoder_lstm(config, n_feat_inp, conditional=True)
-        train = Train(lstm)
+        train = Train(lstm, FeatureEncoding(info) if raw_windows else None, jit_compile, loss_weights, generate_in_graph)
         train.train(train_batches, val_batches, epochs=epochs, early_stop=early_stop)
         attributes = encoder.attributes
 
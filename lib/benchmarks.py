@@ -0,0 +1,411 @@
+import gc
+import time
+import threading
+import calendar
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from .modules import create_masks, SampledSoftmaxDense, FusedHeads
+from .field_info import FieldLayout, field_layouts
+from .losses import FieldLoss, field_losses
+from .generation import SequenceGenerator
+from .prepare_data import preprocess_data_czech
+from .calendar_index import calendar_table, date_to_index
+from .memory import _rss_mb, memory_report
+
+
+def check_kv_cache_parity(transformer, inp, atol=1e-4, compiled=False):
+    """Compares Transformer.decode_step() with the full-prefix forward pass generation used before the cache.
+       inp: (n_seqs, seq_len, n_feat_inp), every prefix inp[:, :t+1] is run through the full path and
+       its last position is compared with the output of the t-th decode_step()
+       compiled=True: compares the compiled inference paths Transformer.infer_step() and Transformer.infer() instead
+       returns the largest absolute difference"""
+    inp = tf.cast(inp, tf.float32)
+    n_seqs, seq_len = inp.shape[0], inp.shape[1]
+    cache = transformer.init_cache(n_seqs, seq_len)
+    max_diff = 0.
+    for t in range(seq_len):
+        prefix = inp[:, :t + 1]
+        if compiled:
+            full = transformer.infer(prefix)[0][:, -1:]
+            step, _ = transformer.infer_step(prefix[:, -1:], cache)
+            max_diff = max(max_diff, float(tf.reduce_max(tf.abs(full - step))))
+            continue
+        x = transformer.input_layer(transformer.field_embedding(prefix))
+        x += transformer.pos_encoding[:, :t + 1, :]
+        mask, _ = create_masks(prefix)
+        out, _ = transformer.DecoderStack(x, False, mask)
+        full = transformer.final_layer(out)[:, -1:]
+
+        step, _ = transformer.decode_step(prefix[:, -1:], cache, training=False)
+        max_diff = max(max_diff, float(tf.reduce_max(tf.abs(full - step))))
+    assert max_diff < atol, f"decode_step differs from the full-prefix path by {max_diff}"
+    return max_diff
+
+
+def check_lstm_step_parity(lstm, inp, atol=1e-4):
+    """Compares Encoder_Decoder_lstm_Inference.step() with the full-prefix forward pass of call(), with the states of
+       the stateful encoder reset before every prefix (generation did not reset them before step(), so its encoder
+       also saw the earlier prefixes). inp: (n_seqs, seq_len, n_feat_inp), the last position of every prefix inp[:, :t+1] is
+       compared with the output of the t-th step()
+       returns the largest absolute difference"""
+    inp = tf.cast(inp, tf.float32)
+    n_seqs, seq_len = inp.shape[0], inp.shape[1]
+    state = lstm.init_state(n_seqs)
+    max_diff = 0.
+    for t in range(seq_len):
+        lstm.reset_states()
+        full = lstm(inp[:, :t + 1], return_decoder_lstm2_output=True)[:, -1:]
+        step = lstm.step(inp[:, t:t + 1], state)
+        max_diff = max(max_diff, float(tf.reduce_max(tf.abs(full - step))))
+    assert max_diff < atol, f"step differs from the full-prefix path by {max_diff}"
+    return max_diff
+
+
+
+def check_fused_heads_parity(model, final_output, inp_out, atol=1e-5):
+    """Compares the fused heads of a conditional model (Transformer, Encoder_Decoder_lstm) with its heads called one
+       by one on [final_output, the fields before their field of inp_out], as call() ran them before.
+       final_output: (n_seqs, seq_len, d_out), inp_out: (n_seqs, seq_len, model.layout_emb.width)
+       returns the largest absolute difference"""
+    fused = model.fused_heads(final_output, inp_out)
+    max_diff = 0.
+    for i, k in enumerate(model.ORDER):
+        head_inp = tf.concat([final_output, model.layout_emb.prefix(inp_out, i)], axis=-1)
+        max_diff = max(max_diff, float(tf.reduce_max(tf.abs(fused[k] - model.fused_heads.heads[k](head_inp)))))
+    assert max_diff < atol, f"the fused heads differ from the heads by {max_diff}"
+    return max_diff
+
+
+def make_synthetic_czech(n_rows, n_accounts=None, seed=0):
+    """raw frame with the columns of tr_by_acct_w_age.csv used by preprocess_data_czech(), sorted by account and date"""
+    rng = np.random.default_rng(seed)
+    n_accounts = n_accounts or max(1, n_rows // 230)
+    account_id = np.sort(rng.integers(0, n_accounts, n_rows))
+    days = np.datetime64('1993-01-01') + rng.integers(0, 6 * 365, n_rows).astype('timedelta64[D]')
+    order = np.lexsort((days, account_id))
+    dates = pd.to_datetime(days[order])
+    types = np.array(['CREDIT', 'DEBIT'], dtype=object)
+    operations = np.array(['CREDIT IN CASH', 'COLLECTION FROM ANOTHER BANK', 'WITHDRAWAL IN CASH', 'REMITTANCE TO ANOTHER BANK', np.nan], dtype=object)
+    k_symbols = np.array(['INTEREST CREDITED', 'HOUSEHOLD', 'PAYMENT FOR STATEMENT', 'INSURRANCE PREMIUM', 'SANCTION INTEREST', '', np.nan], dtype=object)
+    return pd.DataFrame({'account_id': account_id[order],
+                         'date': (dates.year % 100) * 10000 + dates.month * 100 + dates.day,
+                         'type': types[rng.integers(0, len(types), n_rows)],
+                         'operation': operations[rng.integers(0, len(operations), n_rows)],
+                         'k_symbol': k_symbols[rng.integers(0, len(k_symbols), n_rows)],
+                         'amount': np.round(rng.lognormal(7, 1.5, n_rows), 1),
+                         'age': rng.integers(18, 80, n_accounts)[account_id[order]]})
+
+
+def preprocess_data_czech_rowwise(df):
+    """row-wise reference implementation of lib.prepare_data.preprocess_data_czech() (python apply per row)"""
+    df["datetime"] = df["date"].apply(lambda x: datetime.strptime(str(x), "%y%m%d"))
+    df["month"] = df["datetime"].dt.month % 12
+    df["day"] = df["datetime"].dt.day % 31
+    df["dow"] = df["datetime"].dt.dayofweek % 7
+    df["year"] = df["datetime"].dt.year
+    df["td"] = df[["account_id", "datetime"]].groupby("account_id").diff()
+    df["td"] = df["td"].apply(lambda x: x.days)
+    df["td"] = df["td"].fillna(0.0)
+    df["dtme"] = df.datetime.apply(lambda dt: calendar.monthrange(dt.year, dt.month)[1] - dt.day) % 31
+    df['raw_amount'] = df.apply(lambda row: row['amount'] if row['type'] == 'CREDIT' else -row['amount'], axis=1)
+    df["tcode"] = df['type'].astype(str) + "__" + df['operation'].astype(str) + "__" + df['k_symbol'].astype(str)
+    ATTR_SCALE = df["age"].std()
+    df["age_sc"] = df["age"] / ATTR_SCALE
+    df["log_amount"] = np.log10(df["amount"] + 1)
+    LOG_AMOUNT_SCALE = df["log_amount"].std()
+    df["log_amount_sc"] = df["log_amount"] / LOG_AMOUNT_SCALE
+    TD_SCALE = df["td"].std()
+    df["td_sc"] = df["td"] / TD_SCALE
+    field_mappings = {}
+    for field in ['type', 'operation', 'k_symbol', 'tcode']:
+        cat_to_num = dict([(tc, i) for i, tc in enumerate(df[field].unique())])
+        field_mappings[f"{field}_to_num".upper()] = cat_to_num
+        field_mappings[f"num_to_{field}".upper()] = dict([(i, tc) for i, tc in enumerate(df[field].unique())])
+        df[field + "_num"] = df[field].apply(lambda x: cat_to_num[x])
+        df[field] = df[field].astype(str).apply(lambda x: "_" + x if x in ["nan", ""] else x)
+    START_DATE = df["datetime"].min()
+    return df, LOG_AMOUNT_SCALE, TD_SCALE, ATTR_SCALE, START_DATE, field_mappings
+
+
+def benchmark_preprocess(n_rows_list=(1_000_000, 10_000_000), rowwise_max_rows=1_000_000):
+    """times preprocess_data_czech() on synthetic frames, the row-wise reference is only run up to 'rowwise_max_rows' rows"""
+    results = {}
+    for n_rows in n_rows_list:
+        raw = make_synthetic_czech(n_rows)
+        start = time.time()
+        preprocess_data_czech(raw.copy())
+        vectorized = time.time() - start
+        rowwise = None
+        if n_rows <= rowwise_max_rows:
+            start = time.time()
+            preprocess_data_czech_rowwise(raw.copy())
+            rowwise = time.time() - start
+        results[n_rows] = {'vectorized': vectorized, 'rowwise': rowwise}
+        speedup = f", row-wise {rowwise:.1f} secs, speedup {rowwise / vectorized:.1f}x" if rowwise else ""
+        print(f"{n_rows} rows: vectorized {vectorized:.1f} secs{speedup}")
+    return results
+
+
+def benchmark_softmax_heads(vocab_sizes=(16, 1000, 10000, 50000), num_sampled=64, batch_size=64, seq_len=80, d_model=64, steps=20):
+    """training steps/sec of a full softmax head (Dense + sparse categorical cross entropy) and of a SampledSoftmaxDense
+       head with 'num_sampled' classes, for every vocabulary size, on random head inputs and labels"""
+    loss_scce = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    results = {}
+    for vocab in vocab_sizes:
+        x = tf.random.normal((batch_size, seq_len, d_model))
+        labels = tf.random.uniform((batch_size, seq_len), 0, vocab, dtype=tf.int32)
+        full, sampled = tf.keras.layers.Dense(vocab), SampledSoftmaxDense(vocab, num_sampled)
+        full.build(x.shape)
+        sampled.build(x.shape)
+        full_optimizer, sampled_optimizer = tf.keras.optimizers.Adam(), tf.keras.optimizers.Adam()
+        full_optimizer.build(full.trainable_variables)
+        sampled_optimizer.build(sampled.trainable_variables)
+
+        @tf.function
+        def full_step():
+            with tf.GradientTape() as tape:
+                loss = loss_scce(labels, full(x))
+            full_optimizer.apply_gradients(zip(tape.gradient(loss, full.trainable_variables), full.trainable_variables))
+
+        @tf.function
+        def sampled_step():
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_mean(sampled.sampled_loss(x, labels))
+            sampled_optimizer.apply_gradients(zip(tape.gradient(loss, sampled.trainable_variables), sampled.trainable_variables))
+
+        results[vocab] = {}
+        for name, step in [("full", full_step), ("sampled", sampled_step)]:
+            step()          # trace
+            start = time.time()
+            for _ in range(steps):
+                step()
+            results[vocab][name] = steps / (time.time() - start)
+        print(f"vocab {vocab}: full softmax {results[vocab]['full']:.1f} steps/sec, "
+              f"sampled softmax ({num_sampled}) {results[vocab]['sampled']:.1f} steps/sec")
+    return results
+
+
+def benchmark_output_heads(field_dims, batch_size=64, seq_len=80, d_out=128, steps=50):
+    """training steps/sec (forward and backward) of the teacher-forced output heads of the fields in 'field_dims'
+       (field -> output dim, the input dims are the same) run one by one and fused by FusedHeads, on random inputs"""
+    order = list(field_dims)
+    layout = FieldLayout(order, field_dims)
+    heads = dict((k, tf.keras.layers.Dense(dim)) for k, dim in field_dims.items())
+    fused = FusedHeads(heads, layout)
+    final_output = tf.random.normal((batch_size, seq_len, d_out))
+    inp_out = tf.random.normal((batch_size, seq_len, layout.width))
+    fused(final_output, inp_out)        # builds the heads
+    variables = [v for k in order for v in heads[k].trainable_variables]
+
+    @tf.function
+    def sequential_step():
+        with tf.GradientTape() as tape:
+            loss = 0.
+            for i, k in enumerate(order):
+                loss += tf.reduce_mean(heads[k](tf.concat([final_output, layout.prefix(inp_out, i)], axis=-1)))
+        return tape.gradient(loss, variables)
+
+    @tf.function
+    def fused_step():
+        with tf.GradientTape() as tape:
+            loss = tf.add_n([tf.reduce_mean(pred) for pred in fused(final_output, inp_out).values()])
+        return tape.gradient(loss, variables)
+
+    results = {}
+    for name, step in [("sequential", sequential_step), ("fused", fused_step)]:
+        step()          # trace
+        start = time.time()
+        for _ in range(steps):
+            step()
+        results[name] = steps / (time.time() - start)
+    print(f"{len(order)} heads: sequential {results['sequential']:.1f} steps/sec, fused {results['fused']:.1f} steps/sec")
+    return results
+
+
+def benchmark_train_steps(trainer, make_optimizer, batches, steps=20, device="/cpu:0"):
+    """
+    training steps/sec of a Train object of Banksformer/train.py or StackedLSTM/trainlstm.py run eagerly, as a graph
+    function (trainer.make_steps()) and as a graph function compiled with XLA, on 'device'. make_optimizer() returns a
+    new optimizer for every variant, the batches of the dataset 'batches' are repeated. A variant that cannot be run
+    (e.g. an op without an XLA kernel) is reported as None.
+    """
+    signature = trainer.batch_signature(batches)
+    variants = [("eager", dict(compiled=False)), ("graph", dict(compiled=True)), ("xla", dict(compiled=True, jit_compile=True))]
+    results = {}
+    with tf.device(device):
+        for name, kwargs in variants:
+            train_step, _ = trainer.make_steps(make_optimizer(), signature, **kwargs)
+            it = iter(batches.repeat())
+            try:
+                float(train_step(next(it)))        # trace and compile
+            except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+                print(f"{name}: failed, {e.message.splitlines()[0]}")
+                results[name] = None
+                continue
+            start = time.time()
+            for _ in range(steps):
+                loss = train_step(next(it))
+            float(loss)         # wait for the last step
+            results[name] = steps / (time.time() - start)
+            print(f"{name}: {results[name]:.1f} steps/sec")
+    return results
+
+
+def benchmark_field_loss(info, weights, batch_size=64, seq_len=80, steps=50, atol=1e-4):
+    """loss and gradient evaluations/sec of the per-field losses (lib.losses.field_losses) and of the fused FieldLoss
+       for the target layout and loss types of the field info 'info', on random predictions and targets. Asserts that
+       both give the same loss and gradients (within atol)"""
+    layout = field_layouts(info)["TAR"]
+    real = np.zeros((batch_size, seq_len, layout.width), np.float32)
+    for i, k in enumerate(layout.order):
+        if info.LOSS_TYPES[k] == "scce":
+            real[..., layout.starts[i]] = np.random.randint(0, info.FIELD_DIMS_NET[k], (batch_size, seq_len))
+        else:
+            real[..., layout.slices[k]] = np.random.normal(size=(batch_size, seq_len, layout.dims[i]))
+    real = tf.constant(real)
+    preds = dict((k, tf.random.normal((batch_size, seq_len, info.FIELD_DIMS_NET[k]))) for k in layout.order)
+    fused = FieldLoss(layout, info.LOSS_TYPES, weights)
+
+    def per_field(real, preds):
+        return tf.reduce_sum([loss_ * weights[k] for k, loss_ in field_losses(real, preds, layout, info.LOSS_TYPES).items()])
+
+    results, values = {}, {}
+    for name, loss_fn in [("per_field", per_field), ("fused", fused)]:
+        @tf.function
+        def step():
+            with tf.GradientTape() as tape:
+                tape.watch(preds)
+                loss = loss_fn(real, preds)
+            return loss, tape.gradient(loss, preds)
+        values[name] = step()          # trace
+        start = time.time()
+        for _ in range(steps):
+            loss, _ = step()
+        float(loss)
+        results[name] = steps / (time.time() - start)
+    (loss_a, grads_a), (loss_b, grads_b) = values["per_field"], values["fused"]
+    diff = max([abs(float(loss_a - loss_b))] + [float(tf.reduce_max(tf.abs(grads_a[k] - grads_b[k]))) for k in grads_a])
+    assert diff <= atol, f"fused and per-field losses differ by {diff}"
+    print(f"per-field loss {results['per_field']:.1f} steps/sec, fused loss {results['fused']:.1f} steps/sec, max diff {diff:.1e}")
+    return results
+
+
+def benchmark_decode_step(transformer, inp, repeats=3):
+    """secs per generated position of the eager Transformer.decode_step() with dropout (the generation path before
+       Transformer.infer_step()) and of the compiled infer_step(), over the positions of inp (n_seqs, seq_len, n_feat_inp)"""
+    inp = tf.cast(inp, tf.float32)
+    n_seqs, seq_len = inp.shape[0], inp.shape[1]
+    steps = {"decode_step": lambda x, cache: transformer.decode_step(x, cache, training=True),
+             "infer_step": transformer.infer_step}
+    results = {}
+    for name, step in steps.items():
+        step(inp[:, :1], transformer.init_cache(n_seqs, seq_len))      # trace
+        start = time.time()
+        for _ in range(repeats):
+            cache = transformer.init_cache(n_seqs, seq_len)
+            for t in range(seq_len):
+                out, _ = step(inp[:, t:t + 1], cache)
+            float(tf.reduce_sum(out))
+        results[name] = (time.time() - start) / (repeats * seq_len)
+        print(f"{name}: {results[name] * 1e3:.2f} ms per position")
+    return results
+
+
+def benchmark_lstm_generation(lstm, n_seqs=5000, max_len=80, n_feat_inp=None):
+    """secs to run the decoder output of 'max_len' generated positions for 'n_seqs' sequences through an
+       Encoder_Decoder_lstm_Inference, with the full prefix forwarded at every position (the generation path before
+       step()) and with step(), on random inputs (the output heads and the reencoding are the same for both)"""
+    inp = tf.random.normal((n_seqs, max_len, n_feat_inp or lstm.layout_in.width))
+    results = {}
+
+    def prefix_path():
+        for t in range(max_len):
+            out = lstm(inp[:, :t + 1], return_decoder_lstm2_output=True)[:, -1:]
+        return out
+
+    def step_path():
+        state = lstm.init_state(n_seqs)
+        for t in range(max_len):
+            out = lstm.step(inp[:, t:t + 1], state)
+        return out
+
+    lstm.step(inp[:, :1], lstm.init_state(n_seqs))      # trace
+    for name, generate in [("prefix", prefix_path), ("step", step_path)]:
+        lstm.reset_states()
+        start = time.time()
+        float(tf.reduce_sum(generate()))
+        results[name] = time.time() - start
+        print(f"{name}: {results[name]:.1f} secs for {n_seqs} x {max_len} positions")
+    return results
+
+
+def benchmark_generation(model, info, strategy, df, attributes, n_seqs=512, max_length=80, **kwargs):
+    """secs of SequenceGenerator.generate_synthetic_data() for a model of the step protocol, with the loop on the host
+       (a round trip to numpy per step) and as one graph function (compiled=True). Every variant is run once before it
+       is timed, so tracing is not counted. kwargs are passed to SequenceGenerator (e.g. greedy_decode, batch_size)"""
+    results = {}
+    for name, compiled in [("host", False), ("graph", True)]:
+        generator = SequenceGenerator(model, info, strategy, compiled=compiled, **kwargs)
+        generator.generate_synthetic_data(max_length, n_seqs, df, attributes)      # trace
+        start = time.time()
+        generator.generate_synthetic_data(max_length, n_seqs, df, attributes)
+        results[name] = time.time() - start
+        print(f"{name}: {results[name]:.2f} secs for {n_seqs} x {max_length} transactions")
+    return results
+
+
+def _sample_peak_rss(fn, interval=0.005):
+    """result of fn() and the largest current RSS in MB seen while it runs, sampled every 'interval' secs"""
+    peak = [_rss_mb()[0]]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], _rss_mb()[0])
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = fn()
+    finally:
+        done.set()
+        sampler.join()
+    return result, max(peak[0], _rss_mb()[0])
+
+
+def benchmark_sequence_buffer(model, info, strategy, df, attributes, n_seqs=5000, max_length=80, **kwargs):
+    """
+    secs and memory of SequenceGenerator.generate() (the sequence buffer the positions are written into) for a model
+    of the step protocol, with the loop on the host and in the graph (compiled=True), on the inputs of
+    generate_synthetic_data(). Every variant is run once before it is measured, so tracing is not counted.
+    Reported per variant: the MB of the returned buffers, the growth of the RSS over the RSS before the call at its
+    peak during the call (sampled) and after it, and the peak RSS of the process (memory_report() before and after).
+    A flat peak is a peak growth close to the buffer size, the rest is what generate() allocates besides the buffer.
+    kwargs are passed to SequenceGenerator (e.g. greedy_decode, batch_size)
+    """
+    START_DATE = df["datetime"].min()
+    AD = calendar_table(START_DATE, kwargs.get("max_years_span", 15))
+    start_dates = np.random.choice(df.groupby("account_id")["datetime"].min().dt.date.to_list(), size=n_seqs)
+    start_inds = date_to_index(start_dates, START_DATE)
+    TD_SCALE = df["td"].std()
+    results = {}
+    for name, compiled in [("host", False), ("graph", True)]:
+        generator = SequenceGenerator(model, info, strategy, compiled=compiled, **kwargs)
+        inp = generator.first_positions(attributes, n_seqs, df["age"].std())
+        generator.generate(inp[:8], max_length, start_inds[:8], AD, TD_SCALE)       # trace
+        gc.collect()
+        memory_report(f"{name} before generate()")
+        before = _rss_mb()[0]
+        start = time.time()
+        (seqs, date_inds), peak = _sample_peak_rss(lambda: generator.generate(inp, max_length, start_inds, AD, TD_SCALE))
+        secs = time.time() - start
+        memory_report(f"{name} after generate()", seqs=seqs, date_inds=date_inds)
+        results[name] = {"secs": secs, "buffer_mb": (seqs.nbytes + date_inds.nbytes) / 2 ** 20,
+                         "peak_growth_mb": peak - before, "retained_mb": _rss_mb()[0] - before}
+        r = results[name]
+        print(f"{name}: {r['secs']:.2f} secs for {n_seqs} x {max_length} positions, buffers {r['buffer_mb']:.1f} MB, "
+              f"rss +{r['peak_growth_mb']:.1f} MB at peak, +{r['retained_mb']:.1f} MB after")
+        del seqs, date_inds
+    return results
@@ -0,0 +1,79 @@
+import functools
+import numpy as np
+import pandas as pd
+
+# columns of the calendar table AD
+AD_MONTH, AD_DAY, AD_DOW, AD_IDX, AD_YEAR, AD_DTME = range(6)
+
+# how month, day and dow are stored in AD
+#   "mod":    (month % 12, day % 31, weekday % 7), the encoding of preprocess_data_czech() used by Banksformer and the LSTM
+#   "offset": (month - 1, day - 1, weekday - 1), used by BankGAN (monday becomes -1)
+CONVENTIONS = ("mod", "offset")
+
+
+def _days(start_date, span_years):
+    """datetime64[D] of every day from start_date up to (excluding) the same day 'span_years' years later"""
+    start_date = pd.Timestamp(start_date)
+    end_date = start_date.replace(year=start_date.year + span_years)
+    start = np.datetime64(start_date.date(), 'D')
+    return start + np.arange((end_date - start_date).days)
+
+
+def _calendar_fields(days):
+    """month (1-12), day (1-31), weekday (monday=0), year and days in month of datetime64[D] values"""
+    days = np.asarray(days, dtype='datetime64[D]')
+    months = days.astype('datetime64[M]')
+    month = months.astype(np.int64) % 12 + 1
+    day = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+    weekday = (days.astype(np.int64) + 3) % 7          # 1970-01-01 was a thursday
+    year = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    return month, day, weekday, year, days_in_month
+
+
+def days_till_month_end(dates):
+    """dtme of an array/Series of dates, days_in_month - day"""
+    _, day, _, _, days_in_month = _calendar_fields(np.asarray(dates, dtype='datetime64[D]'))
+    return days_in_month - day
+
+
+@functools.lru_cache(maxsize=8)
+def _calendar_table(start_date, span_years, convention):
+    month, day, weekday, year, days_in_month = _calendar_fields(_days(start_date, span_years))
+    dtme = days_in_month - day
+    if convention == "mod":
+        month, day, weekday = month % 12, day % 31, weekday % 7
+    elif convention == "offset":
+        month, day, weekday = month - 1, day - 1, weekday - 1
+    else:
+        raise Exception(f"Got invalid convention: {convention}")
+    AD = np.stack([month, day, weekday, np.arange(len(month)), year, dtme], axis=1)
+    AD.flags.writeable = False      # shared between callers
+    return AD
+
+
+def calendar_table(start_date, span_years, convention="mod"):
+    """
+    AD table of all days from start_date to the same day 'span_years' years later, cached per (start_date, span_years, convention).
+
+    Returns:
+    np.ndarray: read-only int array of shape (n_days, 6), every row is (month, day, dow, idx, year, dtme) of the day
+    start_date + idx, month/day/dow are stored as given by 'convention' (see CONVENTIONS)
+    """
+    return _calendar_table(pd.Timestamp(start_date).normalize(), span_years, convention)
+
+
+def calendar_dates(start_date, span_years):
+    """the days of calendar_table() as a DatetimeIndex, calendar_dates(...)[idx] is the date of row idx"""
+    return pd.DatetimeIndex(_days(start_date, span_years))
+
+
+def date_to_index(dates, start_date):
+    """index in the calendar table starting at start_date of every date in 'dates' (dates, Timestamps or datetime64)"""
+    start = np.datetime64(pd.Timestamp(start_date).date(), 'D')
+    return (pd.to_datetime(pd.Series(dates)).to_numpy().astype('datetime64[D]') - start).astype(np.int64)
+
+
+def index_to_date(inds, start_date):
+    """inverse of date_to_index(), datetime64[D] array"""
+    return np.datetime64(pd.Timestamp(start_date).date(), 'D') + np.asarray(inds, dtype=np.int64)
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import shutil
+import pickle
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+from .prepare_data import preprocess_data_czech
+from .tensor_encoder import ENCODER_VERSION
+
+MAX_CACHE_ENTRIES = 8      # least recently used entries beyond this are evicted
+CACHE_DIR_NAME = "cache"   # default cache directory, created next to the source csv
+STALE_TMP_SECS = 24 * 3600  # temporary directories of writers older than this are left over from crashed runs
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """sha256 of the content of the file at 'path'"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _preprocess_id(preprocess, kwargs=None):
+    """name and kwargs of 'preprocess' and PREPROCESS_VERSION of its module, a new version invalidates old entries"""
+    version = getattr(sys.modules.get(preprocess.__module__), "PREPROCESS_VERSION", 0)
+    return f"{preprocess.__module__}.{preprocess.__name__}{sorted((kwargs or {}).items())}:v{version}"
+
+
+def _write_frame(df, path):
+    try:
+        df.to_parquet(path + ".parquet")
+    except ImportError:       # no parquet engine (pyarrow/fastparquet) installed
+        df.to_pickle(path + ".pkl")
+
+
+def _read_frame(path):
+    if os.path.exists(path + ".parquet"):
+        return pd.read_parquet(path + ".parquet")
+    return pd.read_pickle(path + ".pkl")
+
+
+def _entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+
+
+def _is_tmp(name):
+    """True for the '.{key}.{pid}.tmp' directory an entry is written to before it is renamed into place"""
+    return name.startswith('.') or name.endswith('.tmp')
+
+
+def _read_meta(entry_dir):
+    with open(os.path.join(entry_dir, "meta.pkl"), 'rb') as file:
+        return pickle.load(file)
+
+
+def evict(cache_dir, max_entries=MAX_CACHE_ENTRIES, max_bytes=None):
+    """removes the least recently used entries of 'cache_dir' until at most 'max_entries' entries
+       (and at most 'max_bytes' bytes, if given) are left. Only finished entries (with a meta.pkl) are counted and
+       removed, the temporary directories of concurrent writers are left alone"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = [os.path.join(cache_dir, e) for e in os.listdir(cache_dir) if not _is_tmp(e)]
+    entries = sorted([e for e in entries if os.path.exists(os.path.join(e, "meta.pkl"))], key=os.path.getmtime, reverse=True)
+    total = 0
+    for i, entry in enumerate(entries):
+        total += _entry_size(entry)
+        if i >= max_entries or (max_bytes is not None and total > max_bytes and i > 0):
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def invalidate(cache_dir, source=None, preprocess=None, kwargs=None):
+    """removes all entries of 'cache_dir', or only the ones created from the csv at 'source' (by any version of 'preprocess'
+       called with 'kwargs'). The temporary directories of concurrent writers are kept, unless they are older than
+       STALE_TMP_SECS"""
+    if not os.path.isdir(cache_dir):
+        return
+    for e in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, e)
+        if not os.path.isdir(entry):
+            continue
+        if _is_tmp(e):
+            if time.time() - os.path.getmtime(entry) > STALE_TMP_SECS:
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        try:
+            meta = _read_meta(entry)
+            stale = ((source is None or meta["source"] == os.path.abspath(source)) and
+                     (preprocess is None or meta["preprocess"].rsplit(":v", 1)[0] == _preprocess_id(preprocess, kwargs).rsplit(":v", 1)[0]))
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            stale = True      # incomplete entry
+        if stale:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def load_preprocessed(csv_path, preprocess=preprocess_data_czech, cache_dir=None, max_entries=MAX_CACHE_ENTRIES, max_bytes=None, **kwargs):
+    """
+    Returns preprocess(pd.read_csv(csv_path), **kwargs), reading it from the cache if the same file was already preprocessed
+    by the same version of 'preprocess' with the same kwargs.
+
+    The frame is stored as Parquet (pickle if no parquet engine is installed) together with the other return values of
+    'preprocess' (LOG_AMOUNT_SCALE, TD_SCALE, ATTR_SCALE, START_DATE, field_mappings for lib.prepare_data).
+    Entries are keyed by the sha256 of the csv, the kwargs and the PREPROCESS_VERSION of the module of 'preprocess'. When a new entry
+    is written, older entries of the same csv and preprocessing function are removed and the least recently used entries beyond 'max_entries'/'max_bytes'
+    are evicted.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(csv_path)), CACHE_DIR_NAME)
+    preprocess_id = _preprocess_id(preprocess, kwargs)
+    key = hashlib.sha256((file_fingerprint(csv_path) + preprocess_id).encode()).hexdigest()[:32]
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.exists(os.path.join(entry, "meta.pkl")):
+        print(f"Loading preprocessed data from cache {entry}")
+        os.utime(entry)     # mark as recently used
+        return (_read_frame(os.path.join(entry, "frame")),) + tuple(_read_meta(entry)["outputs"])
+
+    start_time = time.time()
+    df, *outputs = preprocess(pd.read_csv(csv_path), **kwargs)
+    print(f"Preprocessing took {time.time() - start_time:.2f} secs")
+
+    # write to a temporary directory first, so that concurrent readers never see a partial entry
+    os.makedirs(cache_dir, exist_ok=True)
+    invalidate(cache_dir, source=csv_path, preprocess=preprocess, kwargs=kwargs)
+    tmp = os.path.join(cache_dir, f".{key}.{os.getpid()}.tmp")
+    os.makedirs(tmp, exist_ok=True)
+    _write_frame(df, os.path.join(tmp, "frame"))
+    with open(os.path.join(tmp, "meta.pkl"), 'wb') as file:
+        pickle.dump({"source": os.path.abspath(csv_path), "preprocess": preprocess_id, "outputs": outputs}, file)
+    try:
+        os.replace(tmp, entry)
+    except OSError:       # written by a concurrent run in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict(cache_dir, max_entries, max_bytes)
+
+    return (df,) + tuple(outputs)
+
+
+# outputs of the TensorEncoder encode methods, without and with lazy=True
+DENSE_ARRAYS = ["inp_tensor", "tar_tensor", "attributes"]
+LAZY_ARRAYS = ["inp_flat", "tar_flat", "window_starts", "window_lengths", "attributes"]
+RAW_ARRAYS = ["raw_tensor", "window_lengths", "attributes"]
+
+
+def _encoder_key(encoder, method, arguments):
+    """sha256 of everything the output of getattr(encoder, method)(**arguments) depends on: the FieldInfo layout, the
+       sequence lengths, dtype, method and its arguments (stride, lazy, ...) and the encoded columns of the data"""
+    info = encoder.info
+    layout = [info.DATA_KEY_ORDER, info.INP_ENCODINGS, info.TAR_ENCODINGS, info.FIELD_DIMS_IN, info.FIELD_STARTS_IN,
+              info.FIELD_DIMS_TAR, info.FIELD_STARTS_TAR, getattr(info, "CLOCK_DIMS", None)]
+    h = hashlib.sha256(repr([ENCODER_VERSION, layout, encoder.max_seq_len, encoder.min_seq_len, np.dtype(encoder.dtype).name,
+                             method, sorted(arguments.items())]).encode())
+    columns = ["account_id", "age_sc"] + list(info.DATA_KEY_ORDER)
+    h.update(pd.util.hash_pandas_object(encoder.df[columns], index=False).to_numpy().tobytes())
+    return h.hexdigest()[:32]
+
+
+def _open_encoded(encoder, entry):
+    meta = _read_meta(entry)
+    for name in meta["arrays"]:
+        setattr(encoder, name, np.load(os.path.join(entry, name + ".npy"), mmap_mode='r'))
+    for name, value in meta["attrs"].items():
+        setattr(encoder, name, value)
+    encoder.lazy = bool(meta["arguments"].get("lazy"))
+    encoder.raw = bool(meta["arguments"].get("raw"))
+    return encoder
+
+
+def load_encoded(encoder, cache_dir, method="encode", max_entries=MAX_CACHE_ENTRIES, max_bytes=None, **kwargs):
+    """
+    Runs getattr(encoder, method)(**kwargs) (encode, encode_with_overlap or encode_variable_length_with_overlap of a
+    TensorEncoder) and stores its outputs as .npy files in cache_dir. Later calls for the same FieldInfo layout,
+    max_seq_len/min_seq_len, method arguments (stride, lazy, ...) and data skip the encoding.
+
+    In both cases the outputs (inp_tensor, tar_tensor, attributes or, with lazy=True, inp_flat, tar_flat, window_starts,
+    window_lengths, attributes or, with raw=True, raw_tensor, window_lengths, attributes) are set on the encoder as read-only memmaps, so concurrent trainers using the same entry
+    share its pages. Least recently used entries beyond 'max_entries'/'max_bytes' are evicted.
+    """
+    arguments = inspect.signature(getattr(encoder, method)).bind(**kwargs)
+    arguments.apply_defaults()
+    key = _encoder_key(encoder, method, arguments.arguments)
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.exists(os.path.join(entry, "meta.pkl")):
+        print(f"Loading encoded tensors from cache {entry}")
+        os.utime(entry)     # mark as recently used
+        return _open_encoded(encoder, entry)
+
+    getattr(encoder, method)(**kwargs)
+
+    # write to a temporary directory first, so that concurrent readers never see a partial entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = os.path.join(cache_dir, f".{key}.{os.getpid()}.tmp")
+    os.makedirs(tmp, exist_ok=True)
+    arrays = RAW_ARRAYS if arguments.arguments.get("raw") else LAZY_ARRAYS if arguments.arguments.get("lazy") else DENSE_ARRAYS
+    for name in arrays:
+        np.save(os.path.join(tmp, name + ".npy"), getattr(encoder, name))
+    with open(os.path.join(tmp, "meta.pkl"), 'wb') as file:
+        pickle.dump({"method": method, "arguments": arguments.arguments, "arrays": arrays,
+                     "attrs": {"add_attribute_row": encoder.add_attribute_row}}, file)
+    try:
+        os.replace(tmp, entry)
+    except OSError:       # written by a concurrent run in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict(cache_dir, max_entries, max_bytes)
+
+    return _open_encoded(encoder, entry)
@@ -1,8 +1,11 @@
+import numpy as np
+import tensorflow as tf
 from abc import ABC, abstractmethod
 
 class EncodingStrategy(ABC):
     """ cl - clock encoding (2d)
         oh - One-hot encoding
+        emb - integer index, looked up in an embedding table by the models (see configure_vocab())
         raw - no encoding
         cl-i -  clock integer: transforms [1, 2, ..., n] -> [1, 2, ..., n-1, 0]"""
     
@@ -236,8 +239,43 @@ class StrategyFactory:
         elif scenario == 'dateclock_v2':
             return date_clock_encoding_v2()
         
+def vocab_sizes(field_mappings):
+    """number of categories of every categorical field (tcode_num, type_num, ...) in the field_mappings of preprocess_data_czech()"""
+    return dict((key[:-len("_TO_NUM")].lower() + "_num", len(mapping)) for key, mapping in field_mappings.items()
+                if key.endswith("_TO_NUM"))
+
+
+def configure_vocab(info, field_mappings=None, embed_fields=(), embedding_dim=16):
+    """
+    Adapts the categorical fields of a field info to the data, in place.
+    field_mappings: the one-hot input and net dims of the categorical fields are taken from the vocabularies in
+                    field_mappings instead of the constants
+    embed_fields: categorical fields whose input encoding becomes 'emb_*', a single column with the integer index that the
+                  models look up in an embedding table of size (vocab, embedding_dim), so the input width and the first
+                  dense layer do not grow with the vocabulary. info.EMBEDDINGS maps these fields to (vocab, embedding_dim).
+    """
+    vocab = vocab_sizes(field_mappings) if field_mappings is not None else {}
+    info.EMBEDDINGS = {}
+    for k in info.DATA_KEY_ORDER:
+        if k in vocab:
+            if info.INP_ENCODINGS[k].startswith('oh'):
+                info.FIELD_DIMS_IN[k] = vocab[k]
+            if info.NET_ENCODINGS[k].startswith('oh'):
+                info.FIELD_DIMS_NET[k] = vocab[k]
+        if k in embed_fields:
+            enc_type = info.INP_ENCODINGS[k]
+            if not enc_type.startswith('oh'):
+                raise Exception(f"Got invalid enc_type for an embedded field {k}: {enc_type}")
+            info.INP_ENCODINGS[k] = 'emb' + enc_type[len('oh'):]
+            info.EMBEDDINGS[k] = (vocab.get(k, info.FIELD_DIMS_IN[k]), embedding_dim)
+            info.FIELD_DIMS_IN[k] = 1
+    for name in ["IN", "TAR", "NET"]:
+        setattr(info, f"FIELD_STARTS_{name}", FieldLayout(info.DATA_KEY_ORDER, getattr(info, f"FIELD_DIMS_{name}")).start_dict())
+    return info
+
+
 class FIELD_INFO_TCODE():
-      def __init__(self):
+      def __init__(self, field_mappings=None, embed_fields=(), embedding_dim=16):
          
          self.CAT_FIELDS = ['tcode_num']
          self.DATA_KEY_ORDER = self.CAT_FIELDS
@@ -256,9 +294,11 @@ class FIELD_INFO_TCODE():
          self.FIELD_STARTS_IN = {"tcode_num": 0}
          self.FIELD_STARTS_NET = {"tcode_num": 0}
          self.FIELD_STARTS_TAR = {"tcode_num": 0}
+         configure_vocab(self, field_mappings, embed_fields, embedding_dim)
 
 class FIELD_INFO_CATFIELD:
-    def __init__(self):
+    def __init__(self, field_mappings=None, embed_fields=(), embedding_dim=16):
+        """field_mappings, embed_fields, embedding_dim: see configure_vocab()"""
         self.CAT_FIELDS = [ 'k_symbol_num',  'operation_num', 'type_num']
         self.DATA_KEY_ORDER = self.CAT_FIELDS
 
@@ -283,6 +323,7 @@ class FIELD_INFO_CATFIELD:
                               "type_num":None }
         
         self.FIELD_DIMS_IN, self.FIELD_DIMS_TAR, self.FIELD_DIMS_NET, self.FIELD_STARTS_IN, self.FIELD_STARTS_TAR, self.FIELD_STARTS_NET= self._get_field_dims_and_starts()
+        configure_vocab(self, field_mappings, embed_fields, embedding_dim)
 
     def _get_field_dims_and_starts(self):
         ENCODING_DIMS_BY_TYPE = {'oh_type':2,'oh_operation':6, 'oh_symbol':9, 'raw':1 }
@@ -311,7 +352,8 @@ class FIELD_INFO_CATFIELD:
         return field_starts
 
 class FieldInfo_type2:
-    def __init__(self):
+    def __init__(self, field_mappings=None, embed_fields=(), embedding_dim=16):
+        """field_mappings, embed_fields, embedding_dim: see configure_vocab()"""
 
         self.DATA_KEY_ORDER = ['tcode_num', 'td_sc', 'log_amount_sc']    
         self.INP_ENCODINGS = { "td_sc": "raw","log_amount_sc": "raw","tcode_num": "oh_tcode" }    
@@ -320,6 +362,7 @@ class FieldInfo_type2:
         self.LOSS_TYPES = {"td_sc": "pdf", "log_amount_sc": "pdf","tcode_num": "scce"}
         self.ACTIVATIONS =  {"td_sc": "relu", "log_amount_sc": "relu","tcode_num": None}
         self.FIELD_DIMS_IN, self.FIELD_DIMS_TAR, self.FIELD_DIMS_NET, self.FIELD_STARTS_IN, self.FIELD_STARTS_TAR, self.FIELD_STARTS_NET= self._get_field_dims_and_starts()
+        configure_vocab(self, field_mappings, embed_fields, embedding_dim)
 
     def _get_field_dims_and_starts(self):
         ENCODING_DIMS_BY_TYPE = {'oh_tcode':16,'raw':1, 'dist_cont':2 }
@@ -349,7 +392,8 @@ class FieldInfo_type2:
         
         
 class FieldInfo:
-    def __init__(self, scenario):
+    def __init__(self, scenario, field_mappings=None, embed_fields=(), embedding_dim=16):
+        """field_mappings, embed_fields, embedding_dim: see configure_vocab()"""
          
         #self.CAT_FIELDS = [ 'k_symbol_num',  'operation_num', 'type_num']
         self.CAT_FIELDS = ['tcode_num']
@@ -369,6 +413,7 @@ class FieldInfo:
         self.LOSS_TYPES, self.ACTIVATIONS = encoding_strategy.get_loss_type_activ(self.NET_ENCODINGS)
 
         self.FIELD_DIMS_IN, self.FIELD_DIMS_TAR, self.FIELD_DIMS_NET, self.FIELD_STARTS_IN, self.FIELD_STARTS_TAR, self.FIELD_STARTS_NET= self._get_field_dims_and_starts()
+        configure_vocab(self, field_mappings, embed_fields, embedding_dim)
 
     def _get_field_dims_and_starts(self):
         ENCODING_DIMS_BY_TYPE = {'cl-i': 1, 
@@ -399,4 +444,60 @@ class FieldInfo:
         for k in self.DATA_KEY_ORDER:
             field_starts[k] = start
             start += field_dims[k]
-        return field_starts
\ No newline at end of file
+        return field_starts
+
+class FieldLayout:
+    """
+    Compiled view of one layout (input, target or net) of a field info: the fields in 'order' occupy the columns
+    [starts[k], starts[k] + dims[k]) of the last axis. The slice and index tables are computed once, so whole tensors
+    are split, merged and decoded with single ops instead of walking the starts/dims dicts field by field.
+    """
+    def __init__(self, order, dims, starts=None):
+        self.order = list(order)
+        self.dims = [int(dims[k]) for k in self.order]
+        if starts is None:
+            self.starts = np.concatenate([[0], np.cumsum(self.dims)[:-1]]).astype(int)
+        else:
+            self.starts = np.array([starts[k] for k in self.order], dtype=int)
+        self.ends = self.starts + self.dims
+        self.width = int(sum(self.dims))
+        self.slices = dict((k, slice(st, end)) for k, st, end in zip(self.order, self.starts, self.ends))
+        # column indices of the fields, in order, and the position in 'order' of the field of every column
+        self.index = np.concatenate([np.arange(st, end) for st, end in zip(self.starts, self.ends)]).astype(np.int32)
+        self.column_field = np.repeat(np.arange(len(self.order)), self.dims).astype(np.int32)
+        # the fields fill the columns back to back in 'order', so split/merge are a single split/concat
+        self.contiguous = bool(np.array_equal(self.index, np.arange(self.width)))
+
+    def split(self, x):
+        """dict field -> x[..., starts[k]:ends[k]] of a numpy array or tensor"""
+        if not self.contiguous:
+            return dict((k, x[..., s]) for k, s in self.slices.items())
+        if isinstance(x, np.ndarray):
+            parts = np.split(x, self.ends[:-1], axis=-1)
+        else:
+            parts = tf.split(x, self.dims, axis=-1)
+        return dict(zip(self.order, parts))
+
+    def merge(self, parts):
+        """inverse of split(), a tensor with the fields of the dict 'parts' at their columns"""
+        x = tf.concat([parts[k] for k in self.order], axis=-1)
+        if self.contiguous:
+            return x
+        inv = np.argsort(self.index)
+        return tf.gather(x, inv, axis=-1)
+
+    def start_dict(self):
+        """the starts as a dict field -> start, like the FIELD_STARTS_* of a field info"""
+        return dict((k, int(st)) for k, st in zip(self.order, self.starts))
+
+    def prefix(self, x, i):
+        """the columns of the first i fields of 'order', as concatenated by the teacher forcing of the models"""
+        if self.contiguous:
+            return x[..., :self.ends[i - 1]] if i > 0 else x[..., :0]
+        return tf.gather(x, self.index[:sum(self.dims[:i])], axis=-1)
+
+
+def field_layouts(info):
+    """compiled FieldLayout of the input, target and net layouts of a field info, keyed 'IN', 'TAR' and 'NET'"""
+    return dict((name, FieldLayout(info.DATA_KEY_ORDER, getattr(info, f"FIELD_DIMS_{name}"), getattr(info, f"FIELD_STARTS_{name}")))
+                for name in ["IN", "TAR", "NET"])
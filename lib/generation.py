@@ -0,0 +1,508 @@
+import datetime
+import functools
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from .sampling import sample_categorical, sample_next_dates, DATE_DIMS, DATE_FIELDS, DATE_COLUMNS
+from .calendar_index import calendar_table, date_to_index, AD_MONTH, AD_DAY, AD_IDX, AD_YEAR
+from .losses import log_normal_pdf
+
+# days of every month (index 1-12), february without leap years
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def adjust_month_and_day(month, day):
+    """months and days of the AD table (month % 12, day % 31) back to 1-12 and 1-31: month 0 is 12 and day 0 is the
+       last day of its month. Works on scalars and arrays"""
+    month = np.where(month == 0, 12, month)
+    day = np.where(day == 0, DAYS_IN_MONTH[month], day)
+    return month, day
+
+
+def bulk_encode_time_value(val, max_val):
+    """ encoding date features in the clockwise dimension """
+    x = np.sin(2 * np.pi / max_val * val)
+    y = np.cos(2 * np.pi / max_val * val)
+    return np.stack([x, y], axis=1)
+
+
+def clock_to_probs(pt, pts):
+    """unnormalized probabilities of the categories at the clock points pts (dim, 2) from the predicted clock
+       points pt (n_seq, seq_len, 2), by inverse squared distance"""
+    EPS_CLOCKP = 0.01
+    ds = pts[None, None, :, :] - np.asarray(pt)[:, :, None, :]          #(n_seq, seq_len, dim, 2)
+    raw_ps = 1 / np.sum(np.square(ds + EPS_CLOCKP), axis=-1)           #(n_seq, seq_len, dim)
+    return raw_ps / np.sum(raw_ps)
+
+
+def encode_rbf(array, rbf, net_name):
+    """
+    Transform a NumPy array using a fitted RepeatingBasisFunction and convert to a NumPy array of shape (n, num of rbf functions = 2).
+
+    Parameters:
+    array (np.array): Input NumPy array of shape (n,).
+    rbf (RepeatingBasisFunction): Fitted RepeatingBasisFunction object.
+    net_name: name of the the date column('dow', 'month', 'day', 'dtme')
+
+    Returns:
+    np.array: Transformed NumPy array of shape (n, num of rbf functions = 2).
+    """
+    return rbf.transform(pd.DataFrame(array, columns=[net_name]))
+
+
+def encode_onehot(array, net_dim):
+    """
+    Converts an array of numbers to a one-hot encoded numpy array.
+
+    Args:
+    array (array-like): An array of numbers.
+    net_dim (int): The dimension for the one-hot encoding.
+
+    Returns:
+    numpy.ndarray: A numpy array of shape (n, net_dim) with one-hot encoded values.
+    """
+    # Pick the rows of an identity matrix, same result as tf.one_hot without a round trip through TensorFlow
+    return np.eye(net_dim, dtype=np.float32)[np.asarray(array)]
+
+
+def encode_dates(inds, AD, strategy, RBF_dic=None):
+    """the calendar fields of the days inds of AD, encoded as inputs of the models for 'strategy' (n, dim) each"""
+    encoded = {}
+    for k, col in DATE_COLUMNS.items():
+        if strategy == 'banksformer':
+            encoded[k] = bulk_encode_time_value(AD[inds, col], DATE_DIMS[k])
+        elif strategy == 'daterbf':
+            encoded[k] = encode_rbf(AD[inds, col], RBF_dic[k], k)
+        elif strategy == 'dateonehot':
+            encoded[k] = encode_onehot(AD[inds, col], DATE_DIMS[k])
+    return encoded
+
+
+def raw_dates_to_reencoded(raw_preds, start_inds, AD, TD_SCALE, strategy, RBF_dic=None, max_days=100, greedy_decode=False):
+    """
+    raw_preds: raw predictions (info about predicted day, month, dow, and days passed)
+    start_inds: the index of the previous transaction's date in AD or ALL_DATES
+    max_days:  the next transaction date is sampled among the next 100('max_days') days, starting from start_inds
+
+    Computes a number of days passed for each based on inputs (either greedily or with sampling)
+    returns the reencoded 'td_sc' and calendar fields of the new dates (old dates + days passed) and their indices
+    """
+    # raw_preds[k][:, -1]-- get the last element in each sequence, clock outputs are turned into probabilities first
+    all_ps = {}
+    for k in DATE_DIMS:
+        ps = raw_preds[k]
+        if ps.shape[-1] == 2:
+            ps = clock_to_probs(ps, bulk_encode_time_value(np.arange(DATE_DIMS[k]), DATE_DIMS[k]))
+        all_ps[k] = tf.nn.softmax(ps[:, -1]).numpy()
+    timesteps = sample_next_dates(all_ps, np.asarray(raw_preds["td_sc"][:, -1]), start_inds, AD, TD_SCALE, max_days, greedy_decode)
+    inds = start_inds + timesteps
+
+    return_ = encode_dates(inds, AD, strategy, RBF_dic)
+    return_["td_sc"] = (timesteps.astype(np.float32) / TD_SCALE)[:, None]
+    return return_, inds
+
+
+def reencode_net_prediction(net_name, predictions, info, strategy, RBF_dic=None):
+    """net_name is in info.DATA_KEY_ORDER = CAT_FIELD + ['dow', 'month', "day", 'dtme', 'td_sc', 'log_amount_sc']
+       predictions is output by the layer 'net_name' which corresponds to a data field(net_name).
+       function:  transform predictions to the correct form to be used as input to the model
+       the transformed predictions also are used for conditional generating
+       The predictions encode a probablity distribution, and here we sample the appropiate distribution
+       and reencodes the samples to the appropriate input format.
+       Only the last timestep of predictions is sampled (it's the only new one), the returned array has shape (n_seq_to_generate, 1, dim)
+    """
+    predictions = predictions[:, -1:, :]
+    batch_size = predictions.shape[0]
+    if "_num" in net_name:
+        dim = info.FIELD_DIMS_NET[net_name]
+        ps = tf.nn.softmax(predictions[:, -1], axis=-1).numpy()    #predictions: (n_seq_to_generate, 1, dim=16)
+        choosen = sample_categorical(ps)
+        if info.INP_ENCODINGS[net_name].startswith('emb'):
+            return choosen.astype(np.float32)[:, None, None]      #(n_seq_to_generate, 1, 1) index, embedded by the model
+        return encode_onehot(choosen, dim)[:, None, :]      #(n_seq_to_generate, 1, dim=16)
+
+    elif net_name in DATE_DIMS and RBF_dic is None:                  #date representation is Clock Encoding or one-hot encoding
+        dim = info.FIELD_DIMS_NET[net_name]
+        ps = tf.nn.softmax(predictions[:, -1], axis=-1).numpy()
+        choosen = sample_categorical(ps)
+        if strategy == 'banksformer':
+            return np.reshape(bulk_encode_time_value(choosen, max_val=dim), newshape=(batch_size, -1, 2))
+        return np.reshape(encode_onehot(choosen, dim), newshape=(batch_size, -1, dim))
+
+    elif net_name in DATE_DIMS and RBF_dic is not None:               #date representation is RBF
+        ps = tf.nn.softmax(predictions[:, -1], axis=-1).numpy()
+        choosen = sample_categorical(ps)
+        return np.reshape(encode_rbf(choosen, RBF_dic[net_name], net_name), newshape=(batch_size, 1, -1))
+
+    elif net_name in ['td_sc', "log_amount_sc"]:
+        mean, log_var = predictions[:, :, 0:1],  predictions[:, :, 1:2]
+        log_sd = log_var/2.
+        return mean + log_sd * np.random.normal(size=(batch_size, 1, 1))
+    raise Exception(f"Got invalid field {net_name}")
+
+
+def categorical_codes(fields, k, info):
+    """category codes of the field k of sequences split by the input layout, one-hot or index ('emb_*') encoded"""
+    if info.INP_ENCODINGS[k].startswith('emb'):
+        return np.rint(fields[k][..., 0]).astype(int)
+    return np.argmax(fields[k], axis=-1)
+
+
+def embed_prediction(model, net_name, pred):
+    """the reencoded prediction as the heads of the model see it, the index of an 'emb_*' field is looked up in its embedding table"""
+    if net_name in model.field_embedding.embeddings:
+        return model.field_embedding.lookup(net_name, tf.cast(pred, tf.float32))
+    return pred
+
+
+# in-graph versions of the sampling and re-encoding above, used by SequenceGenerator(compiled=True). Tensors hold the
+# newest position only: (n_seqs, dim). Samples are drawn with stateless ops from the seed of every field and step
+
+def encode_time_value_tf(val, max_val):
+    """bulk_encode_time_value() of an int tensor (n,), (n, 2)"""
+    angle = 2 * np.pi / max_val * tf.cast(val, tf.float32)
+    return tf.stack([tf.sin(angle), tf.cos(angle)], axis=1)
+
+
+def clock_to_probs_tf(pt, pts):
+    """clock_to_probs() of predicted clock points pt (n, 2) and the clock points pts (dim, 2)"""
+    EPS_CLOCKP = 0.01
+    raw_ps = 1 / tf.reduce_sum(tf.square(pts[None] - pt[:, None] + EPS_CLOCKP), axis=-1)       #(n, dim)
+    return raw_ps / tf.reduce_sum(raw_ps)
+
+
+def reencode_net_prediction_tf(net_name, predictions, info, strategy, seed):
+    """reencode_net_prediction() of the raw head output of the newest position predictions (n, dim), the sample
+       re-encoded as input (n, dim_in). 'daterbf' needs the fitted RBFs on the host and is not supported (see
+       SequenceGenerator)"""
+    if "_num" in net_name or net_name in DATE_DIMS:
+        dim = info.FIELD_DIMS_NET[net_name]
+        choosen = tf.random.stateless_categorical(predictions, 1, seed, dtype=tf.int32)[:, 0]
+        if "_num" in net_name and info.INP_ENCODINGS[net_name].startswith('emb'):
+            return tf.cast(choosen, tf.float32)[:, None]      #(n, 1) index, embedded by the model
+        if net_name in DATE_DIMS and strategy == 'banksformer':
+            return encode_time_value_tf(choosen, dim)
+        return tf.one_hot(choosen, dim)
+    elif net_name in ['td_sc', "log_amount_sc"]:
+        mean, log_var = predictions[:, 0:1], predictions[:, 1:2]
+        return mean + log_var / 2. * tf.random.stateless_normal(tf.shape(mean), seed)
+    raise Exception(f"Got invalid field {net_name}")
+
+
+def encode_dates_tf(inds, AD, strategy):
+    """encode_dates() of the days inds (n,) of the AD tensor, 'banksformer' or 'dateonehot'"""
+    encoded = {}
+    for k, col in DATE_COLUMNS.items():
+        values = tf.gather(AD[:, col], inds)
+        if strategy == 'banksformer':
+            encoded[k] = encode_time_value_tf(values, DATE_DIMS[k])
+        else:
+            encoded[k] = tf.one_hot(values, DATE_DIMS[k])
+    return encoded
+
+
+def raw_dates_to_reencoded_tf(raw_preds, start_inds, AD, TD_SCALE, strategy, seed, max_days=100, greedy_decode=False):
+    """raw_dates_to_reencoded() in the graph, sample_next_dates() on the AD tensor: raw_preds are the raw head outputs
+       of the newest position (n, dim), start_inds (n,) int32. Returns the reencoded 'td_sc' and calendar fields and
+       the indices of the new dates"""
+    n_days = tf.shape(AD)[0]
+    window = start_inds[:, None] + tf.range(max_days)[None, :]          #(n_seqs, max_days) indices into AD
+    in_range = window < n_days
+    window = tf.minimum(window, n_days - 1)
+
+    log_ps = 0.
+    for k in DATE_FIELDS:
+        ps = raw_preds[k]
+        if ps.shape[-1] == 2:
+            ps = clock_to_probs_tf(ps, encode_time_value_tf(tf.range(DATE_DIMS[k]), DATE_DIMS[k]))
+        ps = tf.nn.softmax(ps)
+        log_ps += tf.math.log(tf.gather(ps, tf.gather(AD[:, DATE_COLUMNS[k]], window) % DATE_DIMS[k], batch_dims=1))
+    td_pred = raw_preds["td_sc"]
+    log_ps += log_normal_pdf(tf.cast(tf.gather(AD[:, AD_IDX], window) - start_inds[:, None], tf.float32),
+                             td_pred[:, 0:1] * TD_SCALE, td_pred[:, 1:2] * TD_SCALE)
+    log_ps = tf.where(in_range, log_ps, -np.inf)
+
+    if greedy_decode:
+        timesteps = tf.argmax(log_ps, axis=1, output_type=tf.int32)
+    else:
+        timesteps = tf.random.stateless_categorical(log_ps - tf.reduce_max(log_ps, axis=1, keepdims=True), 1, seed, dtype=tf.int32)[:, 0]
+    inds = start_inds + timesteps
+
+    return_ = encode_dates_tf(inds, AD, strategy)
+    return_["td_sc"] = (tf.cast(timesteps, tf.float32) / TD_SCALE)[:, None]
+    return return_, inds
+
+
+def category_names(df, field):
+    """code -> category of 'field', the codes of preprocess_data_czech() (order of first appearance)"""
+    return dict(enumerate(df[field].unique()))
+
+
+class SequenceGenerator:
+    """
+    Batched autoregressive generation of synthetic transaction sequences, shared by Banksformer and StackedLSTM.
+
+    The model implements the model-step protocol (lib.modules.Transformer, Encoder_Decoder_lstm_Inference):
+      model.init_state(batch_size, max_len): state of the positions consumed so far
+      model.step(inp_step, state): output of the newest position inp_step (batch_size, 1, features), updates state
+      model.ORDER, model.layout_in, model.field_embedding and the heads: model.fused_heads.heads (field -> head) of a
+      conditional model, or model.dense_layer, model.layout_net and model.ACTIVATIONS if model.conditional is False
+    The generator owns the rest: the first positions from the sampled attributes, the sampling and re-encoding of
+    every field, the next dates and the frames of the generated transactions. Sequences are generated 'batch_size'
+    at a time (all at once if None).
+
+    info: field info of the model, strategy: date encoding of the run ('banksformer', 'daterbf', 'dateonehot'),
+    RBF_dic: fitted RBFs of the date fields for 'daterbf', greedy_decode: take the most likely next date instead of
+    sampling it, max_years_span: years of the calendar table the dates are drawn from
+    compiled=True: every batch is generated by one graph function, a tf.while_loop over the positions that samples
+    with stateless random ops (seeded from np.random), reads the dates from AD as a tensor and writes the positions
+    into a TensorArray, so nothing goes back to the host between steps. The models also implement
+    model.decode_state(inp_step, state) -> (output, new state) and model.state_signature() (TensorSpecs of the state)
+    for it. The graph function has a fixed input signature with a free batch size, so it is traced once for all
+    batches, lengths and scales. The 'daterbf' encoding is not supported.
+    """
+    def __init__(self, model, info, strategy, RBF_dic=None, greedy_decode=False, max_years_span=15, batch_size=None, compiled=False):
+        self.model = model
+        self.info = info
+        self.strategy = strategy
+        self.RBF_dic = RBF_dic
+        self.greedy_decode = greedy_decode
+        self.max_years_span = max_years_span
+        self.batch_size = batch_size
+        self.compiled = compiled
+        if compiled and strategy == 'daterbf':
+            raise Exception(f"Got invalid strategy {strategy} for compiled generation, the rbf dates are encoded on the host")
+        if compiled:
+            signature = [tf.TensorSpec([None, 1, model.layout_in.width], tf.float32), model.state_signature(),
+                         tf.TensorSpec([None], tf.int32), tf.TensorSpec([None, None], tf.int32), tf.TensorSpec([], tf.float32),
+                         tf.TensorSpec([2], tf.int64), tf.TensorSpec([], tf.int32)]
+            # without and with the dates drawn from AD
+            self.generate_fns = [tf.function(functools.partial(self.generate_in_graph, dates=dates), input_signature=signature)
+                                 for dates in (False, True)]
+
+    def predict_fields(self, final_output):
+        """raw outputs of the heads and the re-encoded samples of every field, field -> (n_seqs, 1, dim). The head of a
+           field of a conditional model sees the samples of the fields before it"""
+        model = self.model
+        raw_preds, preds = {}, {}
+        if getattr(model, "conditional", True):
+            for net_name in model.ORDER:
+                raw_preds[net_name] = model.fused_heads.heads[net_name](final_output)
+                preds[net_name] = reencode_net_prediction(net_name, raw_preds[net_name], self.info, self.strategy, self.RBF_dic)
+                final_output = tf.concat([final_output, embed_prediction(model, net_name, preds[net_name])], axis=2)
+        else:
+            final_output = model.dense_layer(final_output)
+            for net_name, pred in model.layout_net.split(final_output).items():
+                acti = model.ACTIVATIONS.get(net_name, None)
+                raw_preds[net_name] = pred if acti is None else tf.keras.activations.relu(pred)
+                preds[net_name] = reencode_net_prediction(net_name, raw_preds[net_name], self.info, self.strategy, self.RBF_dic)
+        return raw_preds, preds
+
+    def step(self, inp_step, state, start_inds=None, AD=None, TD_SCALE=None):
+        """
+        one generated position of every sequence from the newest position inp_step (n_seqs, 1, n_feat_inp).
+        With start_inds (the date indices in AD of the newest positions) the dates are drawn by
+        raw_dates_to_reencoded() and replace the sampled calendar fields and 'td_sc'.
+        Returns the generated position (n_seqs, 1, n_feat_inp) and its date indices (None without start_inds)
+        """
+        raw_preds, preds = self.predict_fields(self.model.step(inp_step, state))
+        encoded = dict((k, np.asarray(pred[:, -1, :], np.float32)) for k, pred in preds.items())
+        inds = None
+        if start_inds is not None:
+            date_info, inds = raw_dates_to_reencoded(raw_preds, start_inds, AD, TD_SCALE, self.strategy, self.RBF_dic,
+                                                     greedy_decode=self.greedy_decode)
+            encoded.update((k, np.asarray(v, np.float32)) for k, v in date_info.items())
+        return np.asarray(self.model.layout_in.merge(encoded))[:, None, :], inds
+
+    def step_in_graph(self, inp_step, state, start_inds, AD, TD_SCALE, seed):
+        """step() in the graph on the tensors of the state: the generated position (n_seqs, 1, n_feat_inp), the new
+           state and the date indices (start_inds if AD is None). Every field is sampled with its own seed"""
+        model = self.model
+        final_output, state = model.decode_state(inp_step, state)
+        seeds = tf.random.experimental.stateless_split(seed, len(model.ORDER) + 1)
+        raw_preds, encoded = {}, {}
+        if getattr(model, "conditional", True):
+            for i, net_name in enumerate(model.ORDER):
+                raw_preds[net_name] = model.fused_heads.heads[net_name](final_output)[:, -1]
+                encoded[net_name] = reencode_net_prediction_tf(net_name, raw_preds[net_name], self.info, self.strategy, seeds[i])
+                final_output = tf.concat([final_output, embed_prediction(model, net_name, encoded[net_name][:, None])], axis=2)
+        else:
+            parts = model.layout_net.split(model.dense_layer(final_output)[:, -1])
+            for i, net_name in enumerate(model.ORDER):
+                acti = model.ACTIVATIONS.get(net_name, None)
+                raw_preds[net_name] = parts[net_name] if acti is None else tf.keras.activations.relu(parts[net_name])
+                encoded[net_name] = reencode_net_prediction_tf(net_name, raw_preds[net_name], self.info, self.strategy, seeds[i])
+        inds = start_inds
+        if AD is not None:
+            date_info, inds = raw_dates_to_reencoded_tf(raw_preds, start_inds, AD, TD_SCALE, self.strategy, seeds[-1],
+                                                        greedy_decode=self.greedy_decode)
+            encoded.update(date_info)
+        return model.layout_in.merge(encoded)[:, None, :], state, inds
+
+    def generate_in_graph(self, inp, state, start_inds, AD, TD_SCALE, seed, max_length, dates=True):
+        """the loop of generate() for one batch as a tf.while_loop (see compiled), returns the generated positions
+           (max_length, n_seqs, n_feat_inp) and their date indices (max_length, n_seqs), position major as the
+           TensorArrays stack them (generate() writes them into its buffer transposed). AD and TD_SCALE are not read
+           if not dates"""
+        AD = AD if dates else None
+        positions = tf.TensorArray(tf.float32, size=max_length)
+        date_inds = tf.TensorArray(tf.int32, size=max_length)
+
+        def body(i, x, state, inds, positions, date_inds):
+            x, state, inds = self.step_in_graph(x, state, inds, AD, TD_SCALE, tf.random.experimental.stateless_fold_in(seed, i))
+            return i + 1, x, state, inds, positions.write(i, x[:, 0]), date_inds.write(i, inds)
+
+        _, _, _, _, positions, date_inds = tf.while_loop(lambda i, *_: i < max_length, body,
+                                                         (tf.constant(0), inp, state, start_inds, positions, date_inds))
+        return positions.stack(), date_inds.stack()
+
+    def generate(self, inp, max_length, start_inds=None, AD=None, TD_SCALE=None):
+        """
+        max_length generated positions after the first positions inp (n_seqs, 1, n_feat_inp), see step().
+        Returns the sequences (n_seqs, max_length + 1, n_feat_inp), first position included, and the date indices of
+        the generated positions (n_seqs, max_length) (None without start_inds).
+        Both are allocated once, every generated position is written in place and the model reads the newest
+        position as a view of the buffer, so the prefix is never copied. In the graph (compiled) the positions of a
+        batch are stacked by the TensorArray and copied into the buffer once at the end of the batch.
+        """
+        n_seqs = len(inp)
+        batch_size = self.batch_size or n_seqs
+        seqs = np.empty((n_seqs, max_length + 1, self.model.layout_in.width), np.float32)
+        seqs[:, 0:1] = inp
+        date_inds = None if start_inds is None else np.empty((n_seqs, max_length), np.int64)
+        AD_tensor = None if AD is None or not self.compiled else tf.constant(AD, tf.int32)
+        for b in range(0, n_seqs, batch_size):
+            batch = seqs[b:b + batch_size]          # view of the sequences of the batch
+            state = self.model.init_state(len(batch), max_length)
+            inds = None if start_inds is None else np.asarray(start_inds[b:b + batch_size])
+            if self.compiled:
+                state['step'] = tf.constant(state['step'], tf.int32)
+                seed = tf.constant(np.random.randint(2 ** 31 - 1, size=2), tf.int64)
+                batch_inds = np.zeros(len(batch), np.int32) if inds is None else inds.astype(np.int32)
+                generated, batch_inds = self.generate_fns[AD is not None](
+                    tf.constant(batch[:, 0:1]), state, tf.constant(batch_inds), tf.zeros((0, 0), tf.int32) if AD is None else AD_tensor,
+                    tf.constant(1. if TD_SCALE is None else TD_SCALE, tf.float32), seed, tf.constant(max_length, tf.int32))
+                batch[:, 1:] = np.swapaxes(generated.numpy(), 0, 1)
+                if date_inds is not None:
+                    date_inds[b:b + batch_size] = batch_inds.numpy().T
+                continue
+            for i in range(max_length):
+                x, inds = self.step(batch[:, i:i + 1], state, inds, AD, TD_SCALE)
+                batch[:, i + 1:i + 2] = x
+                if date_inds is not None:
+                    date_inds[b:b + batch_size, i] = inds
+        return seqs, date_inds
+
+    def first_positions(self, attributes, n_seqs, ATTR_SCALE):
+        """(n_seqs, 1, n_feat_inp) first positions, the attribute (age) sampled from 'attributes' in every column"""
+        seq_ages = np.random.choice(attributes, size=n_seqs) # sample ages from real data
+        return np.repeat(np.array(seq_ages)[:, None, None], repeats=self.model.layout_in.width, axis=2) / ATTR_SCALE
+
+    def split_generated(self, seqs, ATTR_SCALE):
+        """the fields of the generated positions of seqs (see generate()), the first position is dropped"""
+        ages = seqs[:, 0, :] * ATTR_SCALE
+        assert np.sum(np.diff(ages)) == 0, f"Bad formating, expected all entries same in each row, got {ages}"
+        return self.model.layout_in.split(seqs[:, 1:, :])
+
+    def generate_synthetic_data(self, max_length, n_seqs_to_generate, df, attributes):
+        """
+        max_length : length of the generated sequences
+        n_seqs_to_generate: number of unique customers in the generated data
+        df: original preprocessed dataframe
+        attributes: an array of dimension(number_of_seqs_in_training_data,) of scaled attributes(age)
+        Returns a frame of the transactions with amount, tcode, account_id, year, month, day, date and days_passed
+        """
+        START_DATE = df["datetime"].min()
+        ATTR_SCALE = df["age"].std()
+        LOG_AMOUNT_SCALE = df["log_amount"].std()
+        TD_SCALE = df["td"].std()
+        NUM_TO_TCODE = category_names(df, 'tcode')
+
+        AD = calendar_table(START_DATE, self.max_years_span)
+        start_date_opts = df.groupby("account_id")["datetime"].min().dt.date.to_list()   #len = 4500
+        start_dates = np.random.choice(start_date_opts, size=n_seqs_to_generate) # sample start dates from real data
+        start_inds = date_to_index(start_dates, START_DATE)    #array of shape (n_seqs_to_generate,)
+        inp = self.first_positions(attributes, n_seqs_to_generate, ATTR_SCALE)
+
+        seqs, date_inds = self.generate(inp, max_length, start_inds, AD, TD_SCALE)
+
+        # Transform the generated data back to the original data space
+        fields = self.split_generated(seqs, ATTR_SCALE)
+        amts = np.round(10 ** (fields["log_amount_sc"][:, :, 0] * LOG_AMOUNT_SCALE) - 1.0, 2)
+        days_passed = np.round(fields["td_sc"][:, :, 0] * TD_SCALE).astype(int)
+        t_code = categorical_codes(fields, "tcode_num", self.info)
+        num_customers, num_transactions = amts.shape
+
+        df_synth = pd.DataFrame({
+            'amount': amts.flatten(),
+            'tcode': [NUM_TO_TCODE[code] for code in t_code.flatten()],
+        })
+        df_synth['account_id'] = np.repeat(range(num_customers), num_transactions)
+
+        # dates of the generated transactions, customer by customer
+        date_inds = date_inds.flatten()
+        months, days = adjust_month_and_day(AD[date_inds, AD_MONTH], AD[date_inds, AD_DAY])
+        df_synth['year'] = AD[date_inds, AD_YEAR]
+        df_synth['month'] = months
+        df_synth['day'] = days
+        df_synth['date'] = pd.to_datetime(df_synth[['year', 'month', 'day']])
+
+        flattened_days_passed = days_passed.flatten()
+        flattened_days_passed[::num_transactions] = 0  # Setting the first transaction's days_passed to 0
+        df_synth['days_passed'] = flattened_days_passed
+        return df_synth
+
+    def generate_synthetic_tcode(self, max_length, n_seqs_to_generate, df, attributes):
+        """'tcode' sequences, a frame with tcode and account_id"""
+        NUM_TO_TCODE = category_names(df, 'tcode')
+        ATTR_SCALE = df["age"].std()
+        seqs, _ = self.generate(self.first_positions(attributes, n_seqs_to_generate, ATTR_SCALE), max_length)
+        t_code = categorical_codes(self.split_generated(seqs, ATTR_SCALE), "tcode_num", self.info)
+        df_synth = pd.DataFrame({'tcode': [NUM_TO_TCODE[code] for code in t_code.flatten()]})
+        df_synth['account_id'] = np.repeat(range(t_code.shape[0]), t_code.shape[1])
+        return df_synth
+
+    def generate_synthetic_tcode_separated(self, max_length, n_seqs_to_generate, df, attributes):
+        """sequences of the separate categorical fields, a frame with k_symbol, operation, type and account_id"""
+        ATTR_SCALE = df["age"].std()
+        seqs, _ = self.generate(self.first_positions(attributes, n_seqs_to_generate, ATTR_SCALE), max_length)
+        fields = self.split_generated(seqs, ATTR_SCALE)
+        df_synth = pd.DataFrame()
+        for name in ['k_symbol', 'operation', 'type']:
+            num_to_name = category_names(df, name)
+            df_synth[name] = [num_to_name[code] for code in categorical_codes(fields, f"{name}_num", self.info).flatten()]
+        n_customers, n_transactions = fields["k_symbol_num"].shape[:2]
+        df_synth['account_id'] = np.repeat(range(n_customers), n_transactions)
+        return df_synth
+
+    def generate_synthetic_data_type2(self, max_length, n_seqs_to_generate, df, attributes):
+        """for generating data when the inputs are [tcode, amount, td]: a frame with amount, tcode, td, account_id,
+           cumulative_td and datetime, the dates are counted from start dates sampled from the real data"""
+        LOG_AMOUNT_SCALE = df["log_amount"].std()
+        TD_SCALE = df["td"].std()
+        NUM_TO_TCODE = category_names(df, 'tcode')
+        ATTR_SCALE = df["age"].std()
+        inp = self.first_positions(attributes, n_seqs_to_generate, ATTR_SCALE)
+        start_date_opts = df.groupby("account_id")["datetime"].min().dt.date.to_list()   #len = 4500
+        sampled_start_dates = np.random.choice(start_date_opts, size=n_seqs_to_generate) # sample start dates from real data
+
+        seqs, _ = self.generate(inp, max_length)
+        fields = self.split_generated(seqs, ATTR_SCALE)
+        amts = np.round(10 ** (fields["log_amount_sc"][:, :, 0] * LOG_AMOUNT_SCALE) - 1.0, 2)
+        days_passed = np.round(fields["td_sc"][:, :, 0] * TD_SCALE).astype(int)
+        t_code = categorical_codes(fields, "tcode_num", self.info)
+        num_customers, num_transactions = amts.shape
+
+        df_synth = pd.DataFrame({
+            'amount': amts.flatten(),
+            'tcode': [NUM_TO_TCODE[code] for code in t_code.flatten()],
+            'td': days_passed.flatten()
+        })
+        df_synth['account_id'] = np.repeat(range(num_customers), num_transactions)
+        df_synth.loc[::num_transactions, 'td'] = 0      # the first transaction of every account
+        df_synth['cumulative_td'] = df_synth.groupby('account_id')['td'].cumsum()
+
+        # date of every transaction, the start date of its account plus the days passed since the first one
+        start_dates = np.array([datetime.datetime.combine(d, datetime.time()) for d in sampled_start_dates], dtype='datetime64[ns]')
+        df_synth['datetime'] = np.repeat(start_dates, num_transactions) + pd.to_timedelta(df_synth['cumulative_td'], unit='D').to_numpy()
+        return df_synth
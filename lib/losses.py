@@ -0,0 +1,127 @@
+import numpy as np
+import tensorflow as tf
+
+LOSS_GROUPS = ["scce", "pdf", "mse"]
+
+loss_scce_logit = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
+loss_mse = tf.keras.losses.MeanSquaredError(reduction='none')
+
+
+def log_normal_pdf(sample, mean, logvar):
+    log2pi = tf.math.log(2. * np.pi)
+    return -.5 * ((sample - mean) ** 2. * tf.exp(-logvar) + logvar + log2pi)
+
+
+def padding_mask(real):
+    """(batch_size, seq_len) float mask of the positions of the target that are not padding (not all zeros)"""
+    return tf.cast(tf.math.logical_not(tf.math.equal(tf.reduce_sum(real, axis=2), 0)), tf.float32)
+
+
+def field_losses(real, preds, layout, loss_types):
+    """
+    Masked mean loss of every field of the dict 'preds', computed field by field (the reference of FieldLoss).
+    layout: FieldLayout of the target, loss_types: field -> 'scce', 'pdf' or 'mse'. The prediction of an 'scce' field
+    with a sampled softmax head (lib.modules.SampledSoftmaxDense) is already its loss (batch_size, seq_len).
+    """
+    mask = padding_mask(real)
+    real_parts = layout.split(real)
+    losses = {}
+    for k, k_pred in preds.items():
+        real_k = real_parts[k]
+        loss_type = loss_types[k]
+        if loss_type == "scce" and k_pred.shape.rank == 2:
+            loss_ = k_pred
+        elif loss_type == "scce":
+            loss_ = loss_scce_logit(real_k, k_pred)
+        elif loss_type == "pdf":
+            loss_ = -log_normal_pdf(real_k, k_pred[:, :, 0:1], k_pred[:, :, 1:2])[:, :, 0]
+        elif loss_type == "mse":
+            loss_ = loss_mse(real_k, k_pred)
+        else:
+            raise Exception(f"Got invalid loss type {loss_type} for field {k}")
+        losses[k] = tf.reduce_sum(loss_ * mask) / tf.reduce_sum(mask)
+    return losses
+
+
+class FieldLoss:
+    """
+    Weighted sum of the masked mean losses of all fields, as the sum of field_losses() times 'weights', with the fields
+    grouped by loss type instead of looped over:
+    - the padding mask is computed once
+    - the logits of the 'scce' fields with the same number of classes are stacked and scored with one sparse softmax
+      cross entropy
+    - all 'pdf' fields are scored with one log_normal_pdf() and all 'mse' fields with one squared error and one matmul
+      that averages the columns of every field
+    - the per-field losses are reduced together and weighted by a weight vector
+    The grouping tables (the fields of every group, their order and weights and the averaging matrix of the 'mse'
+    fields) are built from the static shapes of the predictions the first time a set of fields is seen (once per trace
+    in a tf.function).
+    layout: FieldLayout of the target, loss_types: field -> 'scce', 'pdf' or 'mse', weights: field -> loss weight
+    """
+    def __init__(self, layout, loss_types, weights):
+        self.layout = layout
+        self.loss_types = dict(loss_types)
+        self.weights = dict(weights)
+        self.columns = dict((k, np.arange(layout.starts[i], layout.ends[i])) for i, k in enumerate(layout.order))
+        self.tables = {}
+
+    def _tables(self, preds):
+        """grouping tables of the fields of 'preds', keyed by the fields and the ones that are already losses"""
+        key = tuple((k, p.shape.rank) for k, p in preds.items())
+        if key in self.tables:
+            return self.tables[key]
+        groups = dict((name, []) for name in LOSS_GROUPS + ["loss"])
+        for k, p in preds.items():
+            if k not in self.weights:
+                raise Exception(f"Got no loss weight for field {k}")
+            loss_type = self.loss_types[k]
+            if loss_type not in LOSS_GROUPS:
+                raise Exception(f"Got invalid loss type {loss_type} for field {k}")
+            groups["loss" if loss_type == "scce" and p.shape.rank == 2 else loss_type].append(k)
+
+        t = {"groups": groups}
+        # the scce fields with the same number of classes are scored together
+        scce_dims = dict()
+        for k in groups["scce"]:
+            scce_dims.setdefault(preds[k].shape[-1], []).append(k)
+        groups["scce"] = [k for ks in scce_dims.values() for k in ks]
+        t["scce_groups"] = list(scce_dims.values())
+        if groups["mse"]:
+            dims = [len(self.columns[k]) for k in groups["mse"]]
+            # averages the squared errors of the columns of every field
+            t["mse_mean"] = np.repeat(np.eye(len(dims), dtype=np.float32) / np.array(dims, dtype=np.float32), dims, axis=0)
+        order = groups["scce"] + groups["pdf"] + groups["mse"] + groups["loss"]
+        t["order"] = order
+        t["weights"] = np.array([self.weights[k] for k in order], dtype=np.float32)
+        self.tables[key] = t
+        return t
+
+    def field_losses(self, real, preds, t=None):
+        """masked mean loss of every field, (n_fields,) in the order of the tables, and the fields in that order.
+           t: the tables of preds if already looked up"""
+        t = t or self._tables(preds)
+        groups = t["groups"]
+        real_parts = self.layout.split(real)
+        parts = []          # (batch_size, seq_len, n_fields_of_group) per group
+        for ks in t["scce_groups"]:
+            logits = tf.stack([preds[k] for k in ks], axis=-2)           #(batch_size, seq_len, n_fields, dim)
+            labels = tf.cast(tf.concat([real_parts[k] for k in ks], axis=-1), tf.int32)
+            parts.append(tf.nn.sparse_softmax_cross_entropy_with_logits(labels, logits))
+        if groups["pdf"]:
+            pdf = tf.stack([preds[k] for k in groups["pdf"]], axis=-2)      #(batch_size, seq_len, n_fields, 2)
+            parts.append(-log_normal_pdf(tf.concat([real_parts[k] for k in groups["pdf"]], axis=-1), pdf[..., 0], pdf[..., 1]))
+        if groups["mse"]:
+            sq = tf.square(tf.concat([preds[k] for k in groups["mse"]], axis=-1) - tf.concat([real_parts[k] for k in groups["mse"]], axis=-1))
+            parts.append(tf.matmul(sq, t["mse_mean"]))
+        if groups["loss"]:
+            parts.append(tf.stack([preds[k] for k in groups["loss"]], axis=-1))
+
+        mask = padding_mask(real)
+        losses = tf.concat(parts, axis=-1)                        #(batch_size, seq_len, n_fields)
+        losses = tf.reduce_sum(losses * mask[..., None], axis=[0, 1]) / tf.reduce_sum(mask)
+        return losses, t["order"]
+
+    def __call__(self, real, preds):
+        t = self._tables(preds)
+        losses, _ = self.field_losses(real, preds, t)
+        return tf.reduce_sum(losses * t["weights"])
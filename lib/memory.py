@@ -0,0 +1,24 @@
+import pandas as pd
+
+
+def _rss_mb():
+    """current and peak resident set size of the process in MB"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024      # KB on linux
+    try:
+        with open("/proc/self/statm") as file:
+            current = int(file.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        current = float("nan")
+    return current, peak
+
+
+def memory_report(stage, **objects):
+    """prints the current and peak RSS after 'stage' and the size of the given frames/arrays"""
+    current, peak = _rss_mb()
+    sizes = []
+    for name, obj in objects.items():
+        n_bytes = obj.memory_usage(deep=True).sum() if isinstance(obj, pd.DataFrame) else obj.nbytes
+        sizes.append(f"{name} {n_bytes / 2 ** 20:.1f} MB")
+    print(f"[memory] {stage}: rss {current:.0f} MB, peak {peak:.0f} MB" + (", " + ", ".join(sizes) if sizes else ""))
+    return current, peak
@@ -1,8 +1,10 @@
 
 import math
+import functools
 import tensorflow as tf 
 import numpy as np
 import random
+from .field_info import FieldLayout, field_layouts
 import os
 
 # random.seed(0)
@@ -161,6 +163,194 @@ class InputEmbedLayer(tf.keras.layers.Layer):
         return x
 
 
+class FeatureEncoding(tf.keras.layers.Layer):
+    """
+    Encodes raw transaction windows inside the graph, the same as TensorEncoder with raw=False does on the host.
+
+    Inputs are raw (batch, max_seq_len, n_fields) with the columns of info.DATA_KEY_ORDER (int codes and scaled floats,
+    any float dtype, e.g. float16), lengths (batch,) of the windows and attributes (batch,). Every field is encoded as
+    given by info.INP_ENCODINGS ('oh*', 'cl', 'raw') and info.TAR_ENCODINGS ('raw', 'cl-i', 'cl'), positions beyond the
+    length of a window are zero and the attribute row is prepended to the inputs if add_attribute_row.
+
+    Returns:
+    (inp, tar) float32 tensors of shape (batch, max_seq_len (+1), n_feat_inp) and (batch, max_seq_len, n_feat_tar)
+    """
+    def __init__(self, info, add_attribute_row=True):
+        super(FeatureEncoding, self).__init__()
+        self.info = info
+        self.add_attribute_row = add_attribute_row
+        self.layouts = field_layouts(info)
+        self.n_feat_inp = self.layouts["IN"].width
+        for k in info.DATA_KEY_ORDER:
+            if info.INP_ENCODINGS[k] == 'rbf':
+                raise Exception(f"Got invalid enc_type for field {k}: rbf, it needs the fitted RBFs and is not encoded in the graph")
+
+    def encode_field(self, x, k, enc_type, depth):
+        """x (batch, seq_len) float32 values of field k"""
+        if enc_type.startswith('oh'):
+            return tf.one_hot(tf.cast(x, tf.int32), depth)
+        elif enc_type == 'cl':
+            angle = 2 * np.pi / self.info.CLOCK_DIMS[k] * x
+            return tf.stack([tf.sin(angle), tf.cos(angle)], axis=-1)
+        elif enc_type in ('raw', 'cl-i') or enc_type.startswith('emb'):
+            return x[:, :, None]
+        raise Exception(f"Got invalid enc_type: {enc_type}")
+
+    def call(self, raw, lengths, attributes):
+        raw = tf.cast(raw, tf.float32)
+        mask = tf.sequence_mask(lengths, tf.shape(raw)[1], dtype=tf.float32)[:, :, None]     #(batch, max_seq_len, 1)
+        inp, tar = {}, {}
+        for i, k in enumerate(self.info.DATA_KEY_ORDER):
+            x = raw[:, :, i]
+            inp[k] = self.encode_field(x, k, self.info.INP_ENCODINGS[k], self.info.FIELD_DIMS_IN[k])
+            tar[k] = self.encode_field(x, k, self.info.TAR_ENCODINGS[k], self.info.FIELD_DIMS_TAR[k])
+        inp = self.layouts["IN"].merge(inp) * mask
+        tar = self.layouts["TAR"].merge(tar) * mask
+        if self.add_attribute_row:
+            attributes = tf.cast(attributes, tf.float32)
+            inp = tf.concat([tf.tile(attributes[:, None, None], [1, 1, self.n_feat_inp]), inp], axis=1)
+        return inp, tar
+
+
+class SampledSoftmaxDense(tf.keras.layers.Layer):
+    """
+    Output head of an 'scce' field with a large vocabulary (see config["SAMPLED_SOFTMAX"] of the models).
+    call() computes the full logits (exact, used for validation and generation), sampled_loss() the sampled softmax loss
+    of the true classes against 'num_sampled' uniformly drawn classes, so the cost of a training step grows with
+    num_sampled instead of the vocabulary. Classes are sampled uniformly since the codes are numbered in order of
+    appearance, not of frequency as the log-uniform sampler assumes.
+    """
+    def __init__(self, units, num_sampled):
+        super(SampledSoftmaxDense, self).__init__()
+        self.units = units
+        self.num_sampled = min(num_sampled, units)
+
+    def build(self, input_shape):
+        # (units, input_dim) as tf.nn.sampled_softmax_loss expects
+        self.kernel = self.add_weight(name="kernel", shape=(self.units, input_shape[-1]), initializer="glorot_uniform", trainable=True)
+        self.bias = self.add_weight(name="bias", shape=(self.units,), initializer="zeros", trainable=True)
+        super(SampledSoftmaxDense, self).build(input_shape)
+
+    def call(self, inputs):
+        return tf.matmul(inputs, self.kernel, transpose_b=True) + self.bias
+
+    def sampled_loss(self, inputs, labels):
+        """sampled softmax loss of every position, inputs (..., input_dim), integer labels (...)"""
+        if not self.built:
+            self.build(inputs.shape)
+        flat_inputs = tf.reshape(inputs, [-1, inputs.shape[-1]])
+        flat_labels = tf.reshape(tf.cast(labels, tf.int64), [-1, 1])
+        sampled = tf.random.uniform_candidate_sampler(flat_labels, 1, self.num_sampled, unique=True, range_max=self.units)
+        loss = tf.nn.sampled_softmax_loss(self.kernel, self.bias, flat_labels, flat_inputs, self.num_sampled, self.units,
+                                          sampled_values=sampled)
+        return tf.reshape(loss, tf.shape(labels))
+
+
+def output_head(name, dim, activation, sampled_softmax):
+    """Dense output head of a field, SampledSoftmaxDense for the fields in 'sampled_softmax' (field -> num_sampled)"""
+    if name in sampled_softmax:
+        if activation is not None:
+            raise Exception(f"Got a sampled softmax head for {name} with activation {activation}")
+        return SampledSoftmaxDense(dim, sampled_softmax[name])
+    return tf.keras.layers.Dense(dim, activation=activation)
+
+
+def categorical_labels(x, embedded):
+    """category codes of an input field x (..., dim), one-hot encoded or an index if 'embedded' ('emb_*')"""
+    if embedded:
+        return tf.cast(tf.round(x[..., 0]), tf.int32)
+    return tf.argmax(x, axis=-1, output_type=tf.int32)
+
+
+def head_output(model, head, net_name, head_inp, raw_out, training):
+    """logits of the output head of field net_name of a model, or its sampled loss against the true codes in raw_out
+       (the input positions that are predicted, not embedded) when training a sampled softmax head"""
+    if training and net_name in model.SAMPLED_SOFTMAX:
+        labels = categorical_labels(model.layout_in.split(raw_out)[net_name], net_name in model.field_embedding.embeddings)
+        return head.sampled_loss(head_inp, labels)       #(batch_size, seq_len)
+    return head(head_inp)
+
+
+class FusedHeads:
+    """
+    The output heads of the fields of a model evaluated together for teacher forcing. The head of field i sees
+    [final_output, the true values of the fields before it], so all of them are columns of one block-masked matmul over
+    [final_output, all fields]: the kernel of every head is padded with zero rows for the fields it does not see and the
+    kernels are concatenated, one matmul and one split replace a concat and a matmul per field. The kernels are built
+    from the weights of the heads at every call, so the heads keep their own weights and are still called one by one
+    for generation. 'heads' maps the fields in layout.order to their Dense (or SampledSoftmaxDense) heads.
+    """
+    def __init__(self, heads, layout):
+        self.heads = heads
+        self.layout = layout
+
+    def __call__(self, final_output, inp_out, exclude=()):
+        """dict field -> predictions of the heads of all fields not in 'exclude', as the heads would return them"""
+        names = [k for k in self.layout.order if k not in exclude]
+        d_out = final_output.shape[-1]
+        kernels, biases, units = [], [], []
+        for name in names:
+            head = self.heads[name]
+            n_prefix = sum(self.layout.dims[:self.layout.order.index(name)])
+            if not head.built:
+                head.build(tf.TensorShape([None, d_out + n_prefix]))
+            kernel = tf.transpose(head.kernel) if isinstance(head, SampledSoftmaxDense) else head.kernel
+            kernels.append(tf.pad(kernel, [[0, self.layout.width - n_prefix], [0, 0]]))
+            biases.append(head.bias)
+            units.append(kernel.shape[-1])
+        if not names:
+            return {}
+
+        x = tf.concat([final_output, self.layout.prefix(inp_out, len(self.layout.order))], axis=-1)
+        out = tf.matmul(x, tf.concat(kernels, axis=1)) + tf.concat(biases, axis=0)     #(batch_size, seq_len, sum(units))
+        preds = {}
+        for name, pred in zip(names, tf.split(out, units, axis=-1)):
+            activation = getattr(self.heads[name], "activation", None)
+            preds[name] = activation(pred) if activation is not None else pred
+        return preds
+
+
+def teacher_forced_heads(model, final_output, inp_out, raw_out, training):
+    """predictions of all field heads of a model from its output and the true fields (teacher forcing). The heads run
+       fused (model.fused_heads), except the sampled softmax heads while training which return their sampled loss"""
+    sampled = [k for k in model.ORDER if training and k in model.SAMPLED_SOFTMAX]
+    preds = model.fused_heads(final_output, inp_out, exclude=sampled)
+    for k in sampled:
+        head_inp = tf.concat([final_output, model.layout_emb.prefix(inp_out, model.ORDER.index(k))], axis=-1)
+        preds[k] = head_output(model, model.fused_heads.heads[k], k, head_inp, raw_out, training)
+    return dict((k, preds[k]) for k in model.ORDER)
+
+
+class FieldEmbedding(tf.keras.layers.Layer):
+    """
+    Replaces the index column of every 'emb_*' input field (see lib.field_info.configure_vocab()) by its vector in an
+    embedding table, 'embeddings' maps these fields to (vocab, embedding_dim). The output has the layout layout_out,
+    the layout of the input with the embedded fields widened to embedding_dim. Without embedded fields it is the identity.
+    Indices are rounded and clipped to the vocabulary, so the attribute row (the attribute in every column) is valid input.
+    """
+    def __init__(self, layout, embeddings):
+        super(FieldEmbedding, self).__init__()
+        self.layout = layout
+        self.embeddings = dict(embeddings)
+        self.tables = dict((k, tf.keras.layers.Embedding(vocab, dim)) for k, (vocab, dim) in self.embeddings.items())
+        dims = dict(zip(layout.order, layout.dims))
+        dims.update((k, dim) for k, (vocab, dim) in self.embeddings.items())
+        self.layout_out = FieldLayout(layout.order, dims)
+
+    def lookup(self, k, x):
+        """embedding vectors (..., embedding_dim) of the indices x (..., 1) of field k"""
+        idx = tf.clip_by_value(tf.cast(tf.round(x[..., 0]), tf.int32), 0, self.embeddings[k][0] - 1)
+        return self.tables[k](idx)
+
+    def call(self, x):
+        if not self.embeddings:
+            return x
+        parts = self.layout.split(x)
+        for k in self.embeddings:
+            parts[k] = self.lookup(k, parts[k])
+        return self.layout_out.merge(parts)
+
+
 class MultiHeadAttention(tf.keras.layers.Layer):
     def __init__(self, d_embedding, d_model, num_heads):
         super(MultiHeadAttention, self).__init__()
@@ -178,24 +368,45 @@ class MultiHeadAttention(tf.keras.layers.Layer):
 
         self.dense = Dense(d_model, d_model, tf.keras.activations.linear)
 
-        
+    def split_heads(self, x, batch_size):
+        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
+        return tf.transpose(x, perm=[0,2,1,3])                 #(batch_size, num_heads, seq_len, depth)
 
     def call(self, x1, x2, x3, combined_mask):
         batch_size = tf.shape(x1)[0]
         q = self.Linear_q(x1)     # (batch_size, seq_len, d_model)
         k = self.Linear_k(x2)     # (batch_size, seq_len, d_model)
         v = self.Linear_v(x3)     # (batch_size, seq_len, d_model)
-        
-        #Split Heads 
-        q = tf.reshape(q, (batch_size, -1, self.num_heads, self.depth))
-        q = tf.transpose(q, perm=[0,2,1,3])                    #(batch_size, num_heads, seq_len, depth)
-
-        k = tf.reshape(k, (batch_size, -1, self.num_heads, self.depth))
-        k = tf.transpose(k, perm=[0,2,1,3])                     #(batch_size, num_heads, seq_len, depth)
-
-        v = tf.reshape(v, (batch_size, -1, self.num_heads, self.depth))
-        v = tf.transpose(v, perm=[0,2,1,3])                      #(batch_size, num_heads, seq_len, depth)
 
+        #Split Heads
+        q = self.split_heads(q, batch_size)                     #(batch_size, num_heads, seq_len, depth)
+        k = self.split_heads(k, batch_size)                     #(batch_size, num_heads, seq_len, depth)
+        v = self.split_heads(v, batch_size)                     #(batch_size, num_heads, seq_len, depth)
+
+        return self.attend(q, k, v, combined_mask, batch_size)
+
+    def call_step(self, x, layer_cache, step, padding_mask):
+        """ attention for the newest position only.
+            x: (batch_size, 1, d_embedding)
+            layer_cache: {'k', 'v'} of shape (batch_size, num_heads, max_len, depth), keys/values of earlier positions
+            step: position of x in the sequence, keys/values after 'step' are masked out
+            padding_mask: (batch_size, 1, 1, max_len) """
+        batch_size = tf.shape(x)[0]
+        q = self.split_heads(self.Linear_q(x), batch_size)      #(batch_size, num_heads, 1, depth)
+        k = self.split_heads(self.Linear_k(x), batch_size)
+        v = self.split_heads(self.Linear_v(x), batch_size)
+
+        # write the new key/value into slot 'step' of the cache
+        max_len = tf.shape(layer_cache['k'])[2]
+        write = tf.one_hot(step, max_len)[tf.newaxis, tf.newaxis, :, tf.newaxis]    #(1, 1, max_len, 1)
+        layer_cache['k'] = layer_cache['k'] * (1. - write) + k * write
+        layer_cache['v'] = layer_cache['v'] * (1. - write) + v * write
+
+        future = tf.cast(tf.range(max_len) > step, tf.float32)[tf.newaxis, tf.newaxis, tf.newaxis, :]
+        mask = tf.maximum(padding_mask, future)                   #(batch_size, 1, 1, max_len)
+        return self.attend(q, layer_cache['k'], layer_cache['v'], mask, batch_size)
+
+    def attend(self, q, k, v, combined_mask, batch_size):
         matmul_qk = tf.matmul(q, k, transpose_b=True)            #scores  (batch_size, num_heads, seq_len_q, seq_len_k)
 
         # scale scores(matmul_qk)
@@ -250,6 +461,19 @@ class DecoderLayer(tf.keras.layers.Layer):
 
         return out2, attn_weights
 
+    def call_step(self, x, training, layer_cache, step, padding_mask):
+        """same as call() for the newest position, keys/values of earlier positions are read from layer_cache"""
+        attn, attn_weights = self.mha.call_step(x, layer_cache, step, padding_mask)
+        attn = self.dropout1(attn, training=training)
+        out1 = self.layernorm1(attn + x)
+
+        out = self.dense1(out1)
+        FC_out = self.dense2(out)
+        FC_out = self.dropout2(FC_out, training=training)
+        out2 = self.layernorm3(FC_out + out1)
+
+        return out2, attn_weights
+
 class Decoder(tf.keras.layers.Layer):
 
     def __init__(self, num_layers, d_inp_decoder, d_model, num_heads, dff, rate=0.1):
@@ -257,7 +481,7 @@ class Decoder(tf.keras.layers.Layer):
 
         self.dec_layers = [DecoderLayer(d_inp_decoder, d_model, num_heads, dff, rate) for _ in range(num_layers)]
         self.num_layers = num_layers
-        
+
     def call(self, x, training, mask):
         attention_weights = {}
         for i in range(self.num_layers):
@@ -265,6 +489,23 @@ class Decoder(tf.keras.layers.Layer):
             attention_weights['decoder_layer{}'.format(i+1)] = attentionweights
         return x, attention_weights
 
+    def init_cache(self, batch_size, max_len):
+        """ key/value cache of every decoder layer, each of shape (batch_size, num_heads, max_len, depth)"""
+        cache = {}
+        for i in range(self.num_layers):
+            mha = self.dec_layers[i].mha
+            shape = (batch_size, mha.num_heads, max_len, mha.depth)
+            cache['decoder_layer{}'.format(i+1)] = {'k': tf.zeros(shape), 'v': tf.zeros(shape)}
+        return cache
+
+    def call_step(self, x, training, cache, step, padding_mask):
+        attention_weights = {}
+        for i in range(self.num_layers):
+            name = 'decoder_layer{}'.format(i+1)
+            x, attentionweights = self.dec_layers[i].call_step(x, training, cache[name], step, padding_mask)
+            attention_weights[name] = attentionweights
+        return x, attention_weights
+
 class Transformer(tf.keras.Model):
     def __init__(self, features,dff, d_embedding, d_model, maximum_position_encoding,num_heads, num_layers,config, rate=0.1):
        super(Transformer, self).__init__()
@@ -275,6 +516,11 @@ class Transformer(tf.keras.Model):
        self.FIELD_STARTS_NET = config["FIELD_STARTS_NET"]
        self.FIELD_DIMS_NET = config["FIELD_DIMS_NET"]
        self.ACTIVATIONS = config["ACTIVATIONS"]
+       self.layout_in = FieldLayout(self.ORDER, self.FIELD_DIMS_IN, self.FIELD_STARTS_IN)
+       # 'emb_*' fields are looked up before the input layer, the heads see the embedded fields too
+       self.field_embedding = FieldEmbedding(self.layout_in, config.get("EMBEDDINGS", {}))
+       self.layout_emb = self.field_embedding.layout_out
+       features = self.layout_emb.width
        
        self.input_layer = tf.keras.Sequential([tf.keras.layers.Input(shape=(None, features)),  InputEmbedLayer(features, dff, d_embedding)])
     #    self.InputLayer = tf.keras.layers.Input(shape=(None, features))
@@ -284,14 +530,32 @@ class Transformer(tf.keras.Model):
        self.DecoderStack = Decoder(num_layers, d_embedding, d_model, num_heads, dff)
        self.final_layer = tf.keras.layers.Dense(d_model, activation=None)
 
+       # fields with a sampled softmax head while training, field -> number of sampled classes
+       self.SAMPLED_SOFTMAX = config.get("SAMPLED_SOFTMAX", {})
        for name, dim in self.FIELD_DIMS_NET.items():
             acti = self.ACTIVATIONS.get(name, None)
-            self.__setattr__(name, tf.keras.layers.Dense(dim, activation=acti))
+            self.__setattr__(name, output_head(name, dim, acti, self.SAMPLED_SOFTMAX))
+       self.fused_heads = FusedHeads(dict((name, self.__getattribute__(name)) for name in self.ORDER), self.layout_emb)
+
+       # graph functions of the inference paths used for generation (see infer() and infer_step()), traced once for
+       # their fixed input signature, without and with the attention maps as output
+       inp_spec = tf.TensorSpec([None, None, self.layout_in.width], tf.float32)
+       cache_spec = dict(('decoder_layer{}'.format(i + 1), {'k': tf.TensorSpec([None, num_heads, None, d_model // num_heads], tf.float32),
+                                                           'v': tf.TensorSpec([None, num_heads, None, d_model // num_heads], tf.float32)})
+                         for i in range(num_layers))
+       step_signature = [inp_spec, tf.TensorSpec([], tf.int32), tf.TensorSpec([None, 1, 1, None], tf.float32), cache_spec]
+       self.infer_fns = [tf.function(functools.partial(self.forward_inference, return_attention=attn), input_signature=[inp_spec])
+                         for attn in (False, True)]
+       self.infer_step_fns = [tf.function(functools.partial(self.decode_inference, return_attention=attn), input_signature=step_signature)
+                              for attn in (False, True)]
      
 
     
 
-    def call(self, inp, tar):
+    def call(self, inp, tar, training=None):
+        """training=True: the sampled softmax heads return the sampled loss of every position instead of the logits"""
+        raw_out = inp[:, 1:]        # the true codes of the predicted positions
+        inp = self.field_embedding(inp)
         inp_inp = inp[:, :-1] # predict next from this
         inp_out = inp[:, 1:]
 
@@ -309,25 +573,101 @@ class Transformer(tf.keras.Model):
         out, attention_weights = self.DecoderStack(x, True, mask)
 
         final_output = self.final_layer(out)
-        preds = {}
-        
-        #print("Final output shape start", final_output.shape)
-        for net_name in self.ORDER:
-            #print("Running net", net_name)
-            pred = self.__getattribute__(net_name)(final_output)
-            #print("pred shape", pred.shape)
-            preds[net_name] = pred
-            
-            st = self.FIELD_STARTS_IN[net_name]
-            end = st + self.FIELD_DIMS_IN[net_name]
-            to_add = inp_out[:, :, st: end]
-            #print("Start and end", st, end)
-            
-            final_output = tf.concat([final_output, to_add], axis=-1)
-            #print("Final output shape after",net_name, "is", final_output.shape, "\n")
-        
+        # the head of field i sees the decoder output and the true values of the fields before it (teacher forcing)
+        preds = teacher_forced_heads(self, final_output, inp_out, raw_out, training)
+
         return preds, attention_weights
-    
+
+    def init_cache(self, batch_size, max_len):
+        """ state for decode_step(): per-layer key/value caches for 'max_len' positions, the padding mask of the
+            positions seen so far and the index of the next position """
+        return {'step': 0,
+                'padding_mask': tf.ones((batch_size, 1, 1, max_len)),
+                'decoder': self.DecoderStack.init_cache(batch_size, max_len)}
+
+    def decode_step(self, inp_step, cache, training=False):
+        """ incremental version of the decoder part of call() used for generation
+            inp_step: (batch_size, 1, features), the newest position of the input sequence
+            cache: created by init_cache(), updated in place
+            returns the output of final_layer for the newest position (batch_size, 1, d_model) and the attention weights """
+        step = cache['step']
+        x = self.input_layer(self.field_embedding(inp_step))
+        x += self.pos_encoding[:, step:step + 1, :]
+        x = self.dropout(x, training=training)
+
+        max_len = tf.shape(cache['padding_mask'])[-1]
+        write = tf.one_hot(step, max_len)[tf.newaxis, tf.newaxis, tf.newaxis, :]
+        cache['padding_mask'] = cache['padding_mask'] * (1. - write) + create_padding_mask(inp_step) * write
+
+        out, attention_weights = self.DecoderStack.call_step(x, training, cache['decoder'], step, cache['padding_mask'])
+        cache['step'] = step + 1
+        return self.final_layer(out), attention_weights
+
+
+    def forward_inference(self, inp, return_attention=False):
+        """ the decoder part of call() for generation: no dropout, the attention maps are only kept if return_attention
+            returns the output of final_layer (batch_size, seq_len, d_model) and the attention weights ({} if not kept) """
+        x = self.input_layer(self.field_embedding(inp))
+        x += self.pos_encoding[:, :tf.shape(x)[1], :]
+        mask, _ = create_masks(inp)
+        out, attention_weights = self.DecoderStack(x, False, mask)
+        return self.final_layer(out), (attention_weights if return_attention else {})
+
+    def decode_inference(self, inp_step, step, padding_mask, decoder_cache, return_attention=False):
+        """ decode_step() without dropout on the tensors of a cache, returns the output, the attention weights ({} if not
+            return_attention) and the updated padding mask and decoder cache """
+        cache = {'step': step, 'padding_mask': padding_mask, 'decoder': tf.nest.map_structure(tf.identity, decoder_cache)}
+        out, attention_weights = self.decode_step(inp_step, cache, training=False)
+        return out, (attention_weights if return_attention else {}), cache['padding_mask'], cache['decoder']
+
+    def infer(self, inp, return_attention=False):
+        """ compiled forward_inference(): output of final_layer for all positions of inp (batch_size, seq_len, features)
+            and the attention weights ({} unless return_attention) """
+        return self.infer_fns[int(return_attention)](tf.cast(inp, tf.float32))
+
+    def infer_step(self, inp_step, cache, return_attention=False):
+        """ compiled decode_step() for generation, without dropout: inp_step (batch_size, 1, features) is the newest
+            position, cache is created by init_cache() and updated in place. Returns the output of final_layer for the
+            newest position (batch_size, 1, d_model) and the attention weights ({} unless return_attention) """
+        out, attention_weights, cache['padding_mask'], cache['decoder'] = self.infer_step_fns[int(return_attention)](
+            tf.cast(inp_step, tf.float32), tf.constant(cache['step'], tf.int32), cache['padding_mask'], cache['decoder'])
+        cache['step'] += 1
+        return out, attention_weights
+
+    # model-step protocol of lib.generation.SequenceGenerator
+    def init_state(self, batch_size, max_len):
+        """ state of step(), the cache of init_cache() """
+        return self.init_cache(batch_size, max_len)
+
+    def step(self, inp_step, state):
+        """ output of final_layer for the newest position inp_step (batch_size, 1, features), by infer_step() """
+        out, _ = self.infer_step(inp_step, state)
+        return out
+
+    def decode_state(self, inp_step, state):
+        """ step() as a function of the state (with a tensor 'step'), for generation loops in the graph: returns the
+            output of the newest position and the new state """
+        out, _, padding_mask, decoder = self.decode_inference(inp_step, state['step'], state['padding_mask'], state['decoder'])
+        return out, {'step': state['step'] + 1, 'padding_mask': padding_mask, 'decoder': decoder}
+
+    def state_signature(self):
+        """ TensorSpecs of the state of decode_state(), any batch size and max_len """
+        decoder = {}
+        for i, layer in enumerate(self.DecoderStack.dec_layers):
+            spec = tf.TensorSpec([None, layer.mha.num_heads, None, layer.mha.depth], tf.float32)
+            decoder['decoder_layer{}'.format(i + 1)] = {'k': spec, 'v': spec}
+        return {'step': tf.TensorSpec([], tf.int32), 'padding_mask': tf.TensorSpec([None, 1, 1, None], tf.float32), 'decoder': decoder}
+
+
+def lstm_cell_step(cell, x_proj, h, c):
+    """ one step of the keras LSTMCell 'cell' (gates i, f, c, o) on an input already projected by its kernel,
+        x_proj = x @ cell.kernel + cell.bias (batch_size, 4 * units). Returns the new h and c """
+    z = x_proj + tf.matmul(h, cell.recurrent_kernel)
+    i, f, g, o = tf.split(z, 4, axis=-1)
+    c = cell.recurrent_activation(f) * c + cell.recurrent_activation(i) * cell.activation(g)
+    h = cell.recurrent_activation(o) * cell.activation(c)
+    return h, c
+
 
 class Encoder_Decoder_lstm(tf.keras.Model):
     """ conditional=True : conditional training and conditional generating of data 
@@ -342,13 +682,21 @@ class Encoder_Decoder_lstm(tf.keras.Model):
         self.FIELD_STARTS_NET = config["FIELD_STARTS_NET"]
         self.FIELD_DIMS_NET = config["FIELD_DIMS_NET"]
         self.ACTIVATIONS = config["ACTIVATIONS"]
+        self.layout_in = FieldLayout(self.ORDER, self.FIELD_DIMS_IN, self.FIELD_STARTS_IN)
+        self.layout_net = FieldLayout(self.ORDER, self.FIELD_DIMS_NET, self.FIELD_STARTS_NET)
+        # 'emb_*' fields are looked up before the encoder, the heads see the embedded fields too
+        self.field_embedding = FieldEmbedding(self.layout_in, config.get("EMBEDDINGS", {}))
+        self.layout_emb = self.field_embedding.layout_out
+        emb_feat = self.layout_emb.width
+        # fields with a sampled softmax head while training (conditional models only), field -> number of sampled classes
+        self.SAMPLED_SOFTMAX = config.get("SAMPLED_SOFTMAX", {})
 
         self.conditional = conditional
         self.config = config
         self.inp_feat = inp_feat
 
         # LSTM layers
-        self.encoder_lstm1 = tf.keras.layers.LSTM(units=unit, return_sequences=True,stateful=False, return_state=True,input_shape=(None, inp_feat))
+        self.encoder_lstm1 = tf.keras.layers.LSTM(units=unit, return_sequences=True,stateful=False, return_state=True,input_shape=(None, emb_feat))
         self.encoder_lstm2 = tf.keras.layers.LSTM(units=unit, return_state=True, stateful=False)
         
         self.decoder_lstm1 = tf.keras.layers.LSTM(units=unit, return_sequences=True)
@@ -360,12 +708,16 @@ class Encoder_Decoder_lstm(tf.keras.Model):
             self.dense_layers = {}
             for name, dim in self.FIELD_DIMS_NET.items():
                 acti = self.ACTIVATIONS.get(name, None)
-                self.dense_layers[name] = tf.keras.layers.Dense(dim, activation=acti)
+                self.dense_layers[name] = output_head(name, dim, acti, self.SAMPLED_SOFTMAX)
+            self.fused_heads = FusedHeads(self.dense_layers, self.layout_emb)
         else:
             self.dense_layer = tf.keras.layers.Dense(net_dim)
  
 
-    def call(self, inp):
+    def call(self, inp, training=None):
+        """training=True: the sampled softmax heads return the sampled loss of every position instead of the logits"""
+        raw_out = inp[:, 1:]        # the true codes of the predicted positions
+        inp = self.field_embedding(inp)
         inp_inp = inp[:, :-1]  # predict next from this
         inp_out = inp[:, 1:]
     
@@ -383,26 +735,15 @@ class Encoder_Decoder_lstm(tf.keras.Model):
         # Predictions for each field
         preds = {}
         if self.conditional:
-            for net_name in self.ORDER:
-                pred = self.dense_layers[net_name](final_output)
-                preds[net_name] = pred
-
-                st = self.FIELD_STARTS_IN[net_name]
-                end = st + self.FIELD_DIMS_IN[net_name]
-                to_add = inp_out[:, :, st:end]
-
-                final_output = tf.concat([final_output, to_add], axis=-1)
+            preds = teacher_forced_heads(self, final_output, inp_out, raw_out, training)
         else:
             final_output = self.dense_layer(final_output)
-            st = 0
-            for name, dim in self.FIELD_DIMS_NET.items():
+            for name, pred in self.layout_net.split(final_output).items():
                 acti = self.ACTIVATIONS.get(name, None)
-                ed = st + dim
                 if acti is None:
-                   preds[name] = final_output[:,:,st:ed]
+                   preds[name] = pred
                 elif acti == 'relu':
-                   preds[name] = tf.keras.activations.relu(final_output[:, :, st:ed])
-                st = ed
+                   preds[name] = tf.keras.activations.relu(pred)
         return preds
     
 
@@ -417,12 +758,20 @@ class Encoder_Decoder_lstm_Inference(tf.keras.Model):
         self.FIELD_STARTS_NET = config["FIELD_STARTS_NET"]
         self.FIELD_DIMS_NET = config["FIELD_DIMS_NET"]
         self.ACTIVATIONS = config["ACTIVATIONS"]
+        self.layout_in = FieldLayout(self.ORDER, self.FIELD_DIMS_IN, self.FIELD_STARTS_IN)
+        self.layout_net = FieldLayout(self.ORDER, self.FIELD_DIMS_NET, self.FIELD_STARTS_NET)
+        # 'emb_*' fields are looked up before the encoder, the heads see the embedded fields too
+        self.field_embedding = FieldEmbedding(self.layout_in, config.get("EMBEDDINGS", {}))
+        self.layout_emb = self.field_embedding.layout_out
+        emb_feat = self.layout_emb.width
+        # fields with a sampled softmax head while training (conditional models only), field -> number of sampled classes
+        self.SAMPLED_SOFTMAX = config.get("SAMPLED_SOFTMAX", {})
 
         self.unit = unit
         self.conditional = conditional
 
         # LSTM layers
-        self.encoder_lstm1 = tf.keras.layers.LSTM(units=unit, return_sequences=True, stateful=True, return_state=True,input_shape=(None, inp_feat))
+        self.encoder_lstm1 = tf.keras.layers.LSTM(units=unit, return_sequences=True, stateful=True, return_state=True,input_shape=(None, emb_feat))
         self.encoder_lstm2 = tf.keras.layers.LSTM(units=unit, return_state=True, stateful=True)
         #self.decoder_repeat_vector = tf.keras.layers.RepeatVector(seq_len)
         self.decoder_lstm1 = tf.keras.layers.LSTM(units=unit, return_sequences=True)
@@ -435,13 +784,78 @@ class Encoder_Decoder_lstm_Inference(tf.keras.Model):
             self.dense_layers = {}
             for name, dim in self.FIELD_DIMS_NET.items():
                 acti = self.ACTIVATIONS.get(name, None)
-                self.dense_layers[name] = tf.keras.layers.Dense(dim, activation=acti)
+                self.dense_layers[name] = output_head(name, dim, acti, self.SAMPLED_SOFTMAX)
+            self.fused_heads = FusedHeads(self.dense_layers, self.layout_emb)
         else:
             self.dense_layer = tf.keras.layers.Dense(net_dim)
 
+        # graph function of step(), traced once for its fixed input signature
+        state_spec = [[tf.TensorSpec([None, unit], tf.float32)] * 2] * 2
+        self.step_fn = tf.function(self.decode_inference, input_signature=[tf.TensorSpec([None, 1, self.layout_in.width], tf.float32),
+                                                                           tf.TensorSpec([], tf.int32), state_spec])
+
+    def init_state(self, batch_size, max_len=None):
+        """ state for step(): (h, c) of both encoder layers, zero, and the number of positions consumed so far.
+            max_len is not needed, the state does not grow with the positions """
+        zeros = tf.zeros((batch_size, self.unit))
+        return {'step': 0, 'encoder': [[zeros, zeros], [zeros, zeros]]}
+
+    def decode_inference(self, inp_step, n_steps, encoder_state):
+        """ the newest position of call(prefix, return_decoder_lstm2_output=True) from the encoder state of the positions
+            before it: the encoder consumes inp_step (batch_size, 1, features) only, then the decoder runs its 'n_steps'
+            (the length of the prefix) steps on the repeated encoder output from the new encoder state, as in call().
+            Returns the decoder output of the newest position (batch_size, 1, unit) and the new encoder state """
+        x = self.field_embedding(inp_step)[:, 0]
+        enc1, enc2 = self.encoder_lstm1.cell, self.encoder_lstm2.cell
+        (h1, c1), (h2, c2) = encoder_state
+        h1, c1 = lstm_cell_step(enc1, tf.matmul(x, enc1.kernel) + enc1.bias, h1, c1)
+        h2, c2 = lstm_cell_step(enc2, tf.matmul(h1, enc2.kernel) + enc2.bias, h2, c2)
+
+        # the decoder state at position n_steps depends on the new encoder state, so it is replayed, not carried over.
+        # Its input is the encoder output at every step, so the input projection of decoder_lstm1 is computed once
+        dec1, dec2 = self.decoder_lstm1.cell, self.decoder_lstm2.cell
+        x_proj = tf.matmul(h2, dec1.kernel) + dec1.bias
+
+        def decoder_step(i, dh1, dc1, dh2, dc2):
+            dh1, dc1 = lstm_cell_step(dec1, x_proj, dh1, dc1)
+            dh2, dc2 = lstm_cell_step(dec2, tf.matmul(dh1, dec2.kernel) + dec2.bias, dh2, dc2)
+            return i + 1, dh1, dc1, dh2, dc2
+
+        _, _, _, out, _ = tf.while_loop(lambda i, *_: i < n_steps, decoder_step, (tf.constant(0), h1, c1, h2, c2))
+        return out[:, None], [[h1, c1], [h2, c2]]
+
+    def step(self, inp_step, state):
+        """ step-wise inference for generation: the output of call(prefix, return_decoder_lstm2_output=True)[:, -1:] of
+            a prefix whose earlier positions were consumed by earlier calls, with states reset before call(). inp_step
+            (batch_size, 1, features) is the newest position, state is created by init_state() and updated in place.
+            The encoder (h, c) is carried over, so the encoder is not rerun on the prefix """
+        self.build_cells()
+        state['step'] += 1
+        out, state['encoder'] = self.step_fn(tf.cast(inp_step, tf.float32), tf.constant(state['step'], tf.int32), state['encoder'])
+        return out
+
+    def decode_state(self, inp_step, state):
+        """ step() as a function of the state (with a tensor 'step'), for generation loops in the graph: returns the
+            output of the newest position and the new state """
+        self.build_cells()
+        out, encoder = self.decode_inference(inp_step, state['step'] + 1, state['encoder'])
+        return out, {'step': state['step'] + 1, 'encoder': encoder}
+
+    def state_signature(self):
+        """ TensorSpecs of the state of decode_state(), any batch size """
+        spec = tf.TensorSpec([None, self.unit], tf.float32)
+        return {'step': tf.TensorSpec([], tf.int32), 'encoder': [[spec, spec], [spec, spec]]}
+
+    def build_cells(self):
+        """ builds the LSTM cells used by decode_inference() if the model has not been called yet """
+        if not self.decoder_lstm2.cell.built:
+            feats = [self.layout_emb.width, self.unit, self.unit, self.unit]
+            for layer, feat in zip([self.encoder_lstm1, self.encoder_lstm2, self.decoder_lstm1, self.decoder_lstm2], feats):
+                layer.cell.build((None, feat))
+
     def call(self, inp, return_decoder_lstm2_output=False):
        
-     
+        inp = self.field_embedding(inp)
         inp_inp = inp
         inp_out = inp
         # Encoder
@@ -461,26 +875,15 @@ class Encoder_Decoder_lstm_Inference(tf.keras.Model):
         # Predictions for each field
         preds = {}
         if self.conditional:
-            for net_name in self.ORDER:
-                pred = self.dense_layers[net_name](final_output)
-                preds[net_name] = pred
-
-                st = self.FIELD_STARTS_IN[net_name]
-                end = st + self.FIELD_DIMS_IN[net_name]
-                to_add = inp_out[:, :, st:end]
-
-                final_output = tf.concat([final_output, to_add], axis=-1)
+            preds = self.fused_heads(final_output, inp_out)
         else:
             final_output = self.dense_layer(final_output)
-            st = 0
-            for name, dim in self.FIELD_DIMS_NET.items():
+            for name, pred in self.layout_net.split(final_output).items():
                 acti = self.ACTIVATIONS.get(name, None)
-                ed = st + dim
                 if acti is None:
-                   preds[name] = final_output[:,:,st:ed]
+                   preds[name] = pred
                 else:
-                   preds[name] = tf.keras.activations.relu(final_output[:, :, st:ed])
-                st = ed
+                   preds[name] = tf.keras.activations.relu(pred)
         return preds
     
 
@@ -1,48 +1,87 @@
 
-from datetime import datetime
-import calendar
 import numpy as np
 import pandas as pd
 import random
 import os
+from .calendar_index import days_till_month_end
 
 # random.seed(0)
 # np.random.seed(0)
 # os.environ['TF_DETERMINISTIC_OPS'] = '1'
 
+# bump when the output of preprocess_data_czech() changes, invalidates entries of lib.data_cache
+PREPROCESS_VERSION = 3
 
-def preprocess_data_czech(df):
-    #df = pd.read_csv('tr_by_acct_w_age.csv')
+CAT_CODE_FIELDS = ['type', 'operation', 'k_symbol']            # concatenated into tcode
+CAT_FIELDS = CAT_CODE_FIELDS + ['tcode']
+TCODE_SEP = "__"
+
+# compact schema of the preprocessed frame, applied by compact_dtypes(). td, log_amount and age keep their dtype since
+# the trainers recompute the scales from them
+COMPACT_DTYPES = {"month": np.int8, "day": np.int8, "dow": np.int8, "dtme": np.int8, "year": np.int16,
+                  "type_num": np.int16, "operation_num": np.int16, "k_symbol_num": np.int16, "tcode_num": np.int16,
+                  "age_sc": np.float32, "log_amount_sc": np.float32, "td_sc": np.float32}
 
-    czech_date_parser = lambda x: datetime.strptime(str(x), "%y%m%d")
-    df["datetime"] = df["date"].apply(czech_date_parser)
-    #df["datetime"] = pd.to_datetime(df["datetime"])
 
+def add_date_fields(df):
+    """calendar fields of df["datetime"]"""
     df["month"] = df["datetime"].dt.month % 12
     df["day"] = df["datetime"].dt.day % 31
     df["dow"] =  df["datetime"].dt.dayofweek % 7
     df["year"] = df["datetime"].dt.year
-    
-    df["td"] = df[["account_id", "datetime"]].groupby("account_id").diff()
-    df["td"] = df["td"].apply(lambda x: x.days)
-    df["td"].fillna(0.0, inplace=True)
-    
 
-    # dtme - days till month end
-    df["dtme"] = df.datetime.apply(lambda dt: calendar.monthrange(dt.year, dt.month)[1] - dt.day) % 31
 
-    df['raw_amount'] = df.apply(lambda row: row['amount'] if row['type'] == 'CREDIT' else -row['amount'], axis=1)
+def add_code_fields(df):
+    """dtme, raw_amount and tcode, computed from each row alone"""
+    # dtme - days till month end
+    df["dtme"] = days_till_month_end(df["datetime"]) % 31
 
+    df['raw_amount'] = np.where(df['type'] == 'CREDIT', df['amount'], -df['amount'])
 
-    cat_code_fields = ['type', 'operation', 'k_symbol']
-    TCODE_SEP = "__"
-    # create tcode by concating fields in "cat_code_fields"
-    tcode = df[cat_code_fields[0]].astype(str)
-    for ccf in cat_code_fields[1:]:
+    # create tcode by concating fields in "CAT_CODE_FIELDS"
+    tcode = df[CAT_CODE_FIELDS[0]].astype(str)
+    for ccf in CAT_CODE_FIELDS[1:]:
         tcode += TCODE_SEP + df[ccf].astype(str)
 
     df["tcode"] = tcode
 
+
+def category_labels(uniques):
+    """string labels of the categories 'uniques', '_' is added to nan and blank so they are always interpreted as strings"""
+    labels = pd.Series(uniques).astype(str)
+    labels = labels.mask(labels.isin(["nan", ""]), "_" + labels)
+    return labels.to_numpy()
+
+
+def compact_dtypes(df, labels):
+    """casts the columns of df to COMPACT_DTYPES in place, the fields in CAT_FIELDS become pandas categoricals with
+       the categories 'labels[field]' (in the order of the *_num codes)"""
+    for field in CAT_FIELDS:
+        df[field] = pd.Categorical(df[field], categories=pd.unique(labels[field]))
+    for k, dtype in COMPACT_DTYPES.items():
+        if k in df:
+            df[k] = df[k].astype(dtype)
+    return df
+
+
+def _parse_dates(df):
+    """parses every distinct date once and broadcasts it back to the rows"""
+    date_codes, dates = pd.factorize(df["date"])
+    df["datetime"] = pd.to_datetime(pd.Series(dates).astype(str), format="%y%m%d").to_numpy()[date_codes]
+
+
+def preprocess_data_czech(df, compact=False):
+    """compact: cast the frame to the compact schema of compact_dtypes()"""
+    #df = pd.read_csv('tr_by_acct_w_age.csv')
+
+    _parse_dates(df)
+    add_date_fields(df)
+    
+    df["td"] = df.groupby("account_id")["datetime"].diff().dt.days
+    df["td"] = df["td"].fillna(0.0)
+    
+    add_code_fields(df)
+
     ATTR_SCALE = df["age"].std()
     df["age_sc"] = df["age"] / ATTR_SCALE
 
@@ -53,22 +92,123 @@ def preprocess_data_czech(df):
     TD_SCALE = df["td"].std()
     df["td_sc"] = df["td"] / TD_SCALE
 
-    cat_fields = ['type', 'operation', 'k_symbol', 'tcode']
-
     field_mappings = {}
-    for field in cat_fields:
+    labels = {}
+    for field in CAT_FIELDS:
         
-        # Create the category to number mapping
-        cat_to_num = dict([(tc, i) for i, tc in enumerate(df[field].unique())])
+        # codes are given in order of first appearance, same as enumerate(df[field].unique())
+        codes, uniques = pd.factorize(df[field], use_na_sentinel=False)
         
         # Store the mappings in the field_mappings dictionary
-        field_mappings[f"{field}_to_num".upper()] = cat_to_num
-        field_mappings[f"num_to_{field}".upper()] = dict([(i, tc) for i, tc in enumerate(df[field].unique())])
+        field_mappings[f"{field}_to_num".upper()] = dict([(tc, i) for i, tc in enumerate(uniques)])
+        field_mappings[f"num_to_{field}".upper()] = dict([(i, tc) for i, tc in enumerate(uniques)])
 
-        df[field + "_num"] = df[field].apply(lambda x: cat_to_num[x])
+        df[field + "_num"] = codes
         
-        # add '_' to nan and blank so they are always interpreted as strings
-        df[field] = df[field].astype(str).apply(lambda x: "_" + x  if x in ["nan", ""]  else x)
+        labels[field] = category_labels(uniques)
+        df[field] = labels[field][codes]
+
+    if compact:
+        compact_dtypes(df, labels)
 
     START_DATE = df["datetime"].min()
-    return df, LOG_AMOUNT_SCALE, TD_SCALE, ATTR_SCALE, START_DATE, field_mappings
\ No newline at end of file
+    return df, LOG_AMOUNT_SCALE, TD_SCALE, ATTR_SCALE, START_DATE, field_mappings
+
+
+def _add_td(df, last_date):
+    """td of every row of the chunk df, 'last_date' maps account_id -> date of its last transaction in the previous chunks,
+       it is updated in place so td stays correct for accounts spanning several chunks"""
+    prev = df.groupby("account_id")["datetime"].shift()
+    first = prev.isna()
+    if first.any() and last_date:
+        prev[first] = df.loc[first, "account_id"].map(last_date)
+    df["td"] = (df["datetime"] - prev).dt.days
+    df["td"] = df["td"].fillna(0.0)
+    last_date.update(df.groupby("account_id")["datetime"].last())
+
+
+class _RunningStd:
+    """running count, mean and sum of squared deviations (Welford/Chan), std() is the sample std like pandas"""
+    def __init__(self):
+        self.n, self.mean, self.m2 = 0, 0., 0.
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        n_b = len(x)
+        if n_b == 0:
+            return
+        mean_b = x.mean()
+        m2_b = ((x - mean_b) ** 2).sum()
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta ** 2 * self.n * n_b / n
+        self.n = n
+
+    def std(self):
+        return np.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else np.nan
+
+
+def preprocess_data_czech_chunked(csv_path, chunksize=1_000_000, compact=False):
+    """
+    Streaming version of preprocess_data_czech() for csv files that do not fit in memory.
+
+    The first pass reads the csv in chunks of 'chunksize' rows and accumulates the scales (running std), the category
+    vocabularies (in order of first appearance, as in preprocess_data_czech()) and the first date. The second pass is
+    done by the returned 'chunks' function, every call reads the csv again and yields the preprocessed chunks.
+    The date of the last transaction of every account is carried across chunks, so td is the same as in the in-memory
+    version even when the transactions of an account are split over several chunks.
+    With compact=True every chunk is cast to the compact schema of compact_dtypes(), the categoricals of all chunks share
+    the same categories.
+
+    Returns:
+    tuple: chunks, LOG_AMOUNT_SCALE, TD_SCALE, ATTR_SCALE, START_DATE, field_mappings
+    """
+    stds = dict((k, _RunningStd()) for k in ["age", "log_amount", "td"])
+    vocabs = dict((field, pd.Index([], dtype=object)) for field in CAT_FIELDS)
+    last_date = {}
+    START_DATE = None
+
+    for df in pd.read_csv(csv_path, chunksize=chunksize):
+        _parse_dates(df)
+        _add_td(df, last_date)
+        add_code_fields(df)
+
+        stds["age"].update(df["age"])
+        stds["log_amount"].update(np.log10(df["amount"]+1))
+        stds["td"].update(df["td"])
+        for field in CAT_FIELDS:
+            uniques = pd.Index(pd.unique(df[field]), dtype=object)
+            vocabs[field] = vocabs[field].append(uniques[vocabs[field].get_indexer(uniques) < 0])
+        START_DATE = df["datetime"].min() if START_DATE is None else min(START_DATE, df["datetime"].min())
+
+    ATTR_SCALE, LOG_AMOUNT_SCALE, TD_SCALE = stds["age"].std(), stds["log_amount"].std(), stds["td"].std()
+
+    field_mappings = {}
+    for field in CAT_FIELDS:
+        field_mappings[f"{field}_to_num".upper()] = dict([(tc, i) for i, tc in enumerate(vocabs[field])])
+        field_mappings[f"num_to_{field}".upper()] = dict([(i, tc) for i, tc in enumerate(vocabs[field])])
+    labels = dict((field, category_labels(vocabs[field])) for field in CAT_FIELDS)
+
+    def chunks():
+        last_date = {}
+        for df in pd.read_csv(csv_path, chunksize=chunksize):
+            _parse_dates(df)
+            add_date_fields(df)
+            _add_td(df, last_date)
+            add_code_fields(df)
+
+            df["age_sc"] = df["age"] / ATTR_SCALE
+            df["log_amount"] = np.log10(df["amount"]+1)
+            df["log_amount_sc"] = df["log_amount"] / LOG_AMOUNT_SCALE
+            df["td_sc"] = df["td"] / TD_SCALE
+
+            for field in CAT_FIELDS:
+                codes = vocabs[field].get_indexer(df[field])
+                df[field + "_num"] = codes
+                df[field] = labels[field][codes]
+            if compact:
+                compact_dtypes(df, labels)
+            yield df
+
+    return chunks, LOG_AMOUNT_SCALE, TD_SCALE, ATTR_SCALE, START_DATE, field_mappings
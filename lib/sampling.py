@@ -0,0 +1,71 @@
+import numpy as np
+from .calendar_index import AD_MONTH, AD_DAY, AD_DOW, AD_IDX, AD_DTME
+
+
+def sample_categorical(ps):
+    """
+    Draws one sample from every row of a matrix of categorical distributions (inverse-CDF sampling).
+    Equivalent to [np.random.choice(ps.shape[1], p=p) for p in ps], but without a python loop over the rows.
+
+    Args:
+    ps (np.ndarray): array of shape (n, dim), rows are (possibly unnormalized) probabilities.
+
+    Returns:
+    np.ndarray: integer array of shape (n,) with the sampled categories.
+    """
+    cdf = np.cumsum(ps, axis=1)
+    u = np.random.random_sample((ps.shape[0], 1)) * cdf[:, -1:]
+    return np.minimum(np.sum(cdf < u, axis=1), ps.shape[1] - 1)
+
+
+# calendar fields scored by sample_next_dates(), their column in the AD table (lib.calendar_index) and number of categories
+DATE_FIELDS = ['month', 'day', 'dow', 'dtme']
+DATE_COLUMNS = {"month": AD_MONTH, "day": AD_DAY, "dow": AD_DOW, "dtme": AD_DTME}
+DATE_DIMS = {'month': 12, 'day': 31, 'dow': 7, 'dtme': 31}
+
+
+def log_normal_pdf_np(sample, mean, logvar):
+    log2pi = np.log(2. * np.pi)
+    return -.5 * ((sample - mean) ** 2. * np.exp(-logvar) + logvar + log2pi)
+
+
+def sample_next_dates(date_ps, td_pred, start_inds, AD, TD_SCALE, max_days=100, greedy_decode=False):
+    """
+    Chooses the date of the next transaction of every sequence among the 'max_days' days following start_inds.
+    Every candidate day is scored with p(month) * p(day) * p(dow) * p(dtme) * p(time delta), the score of all
+    sequences is computed at once in log space.
+
+    Args:
+    date_ps (dict): 'month', 'day', 'dow', 'dtme' -> array of shape (n_seqs, dim), predicted probabilities of the calendar fields
+    td_pred (np.ndarray): array of shape (n_seqs, 2), predicted mean and log variance of the scaled time delta
+    start_inds (np.ndarray): array of shape (n_seqs,), index of the previous transaction's date in AD
+    AD (np.ndarray): array of shape (n_days, 6), (month, day, dow, idx, year, dtme) of every day
+    TD_SCALE (float): scale of the time delta
+    max_days (int): number of candidate days
+    greedy_decode (bool): take the most likely day instead of sampling
+
+    Returns:
+    np.ndarray: integer array of shape (n_seqs,), the number of days passed since start_inds
+    """
+    start_inds = np.asarray(start_inds)
+    window = start_inds[:, None] + np.arange(max_days)[None, :]      #(n_seqs, max_days) indices into AD
+    in_range = window < len(AD)
+    window = np.minimum(window, len(AD) - 1)
+
+    # gather the probabilities of all four calendar fields with one lookup into the concatenated probability matrix
+    dims = np.array([DATE_DIMS[k] for k in DATE_FIELDS])
+    offsets = np.cumsum(dims) - dims
+    ps = np.concatenate([date_ps[k] for k in DATE_FIELDS], axis=1)                  #(n_seqs, sum(dims))
+    cal = AD[:, [DATE_COLUMNS[k] for k in DATE_FIELDS]] % dims + offsets              #(n_days, 4)
+    idx = cal[window].reshape(len(start_inds), -1)                                   #(n_seqs, max_days * 4)
+    with np.errstate(divide='ignore'):
+        log_ps = np.log(np.take_along_axis(ps, idx, axis=1)).reshape(len(start_inds), max_days, -1).sum(axis=-1)
+
+    td_pred = np.asarray(td_pred, dtype=np.float64)
+    log_ps += log_normal_pdf_np(AD[window, AD_IDX] - start_inds[:, None],
+                                mean=td_pred[:, 0:1] * TD_SCALE, logvar=td_pred[:, 1:2] * TD_SCALE)
+    log_ps = np.where(in_range, log_ps, -np.inf)
+
+    if greedy_decode:
+        return np.argmax(log_ps, axis=1)
+    return sample_categorical(np.exp(log_ps - np.max(log_ps, axis=1, keepdims=True)))
@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import numpy as np
+import tensorflow as tf
+
+SHARD_META = "meta.json"
+SPLITS = ("train", "val")
+
+
+def _window_example(inp, tar):
+    """tf.train.Example of one window, the arrays are stored as raw bytes, their shapes are in the meta file"""
+    return tf.train.Example(features=tf.train.Features(feature={
+        "inp": tf.train.Feature(bytes_list=tf.train.BytesList(value=[inp.tobytes()])),
+        "tar": tf.train.Feature(bytes_list=tf.train.BytesList(value=[tar.tobytes()])),
+    })).SerializeToString()
+
+
+def export_shards(encoders, out_dir, n_shards=16, val_fraction=0.2, block_size=4096, compression="", seed=None):
+    """
+    Writes the windows of one or more encoded TensorEncoders to TFRecord shards that are read back by shard_dataset().
+
+    'encoders' is a TensorEncoder (dense or lazy encoding) or an iterable of them, e.g. encode_chunks(), in which case
+    only one encoder is held in memory at a time. The windows of every encoder are shuffled and a fraction 'val_fraction'
+    of them goes to out_dir/val, the rest to out_dir/train. Every split is spread over 'n_shards' files, consecutive
+    windows go to different shards so every shard is a sample of the whole corpus. 'compression' is "" or "GZIP".
+    The shards are written to a temporary directory that is renamed to out_dir at the end.
+
+    Returns:
+    dict: the meta data of out_dir (window shapes, dtype, number of windows per split, ...)
+    """
+    if hasattr(encoders, "attributes"):
+        encoders = [encoders]
+    rng = np.random.default_rng(seed)
+    options = tf.io.TFRecordOptions(compression_type=compression)
+
+    tmp = out_dir.rstrip("/") + f".{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    writers = {}
+    for split in SPLITS:
+        os.makedirs(os.path.join(tmp, split))
+        writers[split] = [tf.io.TFRecordWriter(os.path.join(tmp, split, f"shard-{i:05d}-of-{n_shards:05d}.tfrecord"), options)
+                          for i in range(n_shards)]
+    meta = {"n_shards": n_shards, "compression": compression, "n_windows": dict((split, 0) for split in SPLITS)}
+
+    try:
+        for encoder in encoders:
+            n_seqs = len(encoder.attributes)
+            inds = rng.permutation(n_seqs)
+            n_val = int(round(n_seqs * val_fraction))
+            for split, split_inds in zip(SPLITS, (inds[n_val:], inds[:n_val])):
+                for b in range(0, len(split_inds), block_size):
+                    inp, tar = encoder.windows(split_inds[b:b + block_size])
+                    if "dtype" not in meta:
+                        meta.update(dtype=inp.dtype.name, inp_shape=list(inp.shape[1:]), tar_shape=list(tar.shape[1:]))
+                    elif [meta["inp_shape"], meta["tar_shape"]] != [list(inp.shape[1:]), list(tar.shape[1:])]:
+                        raise Exception(f"Got windows of shape {inp.shape[1:]}, {tar.shape[1:]}, expected {meta['inp_shape']}, {meta['tar_shape']}")
+                    for i in range(len(inp)):
+                        writers[split][meta["n_windows"][split] % n_shards].write(_window_example(inp[i], tar[i]))
+                        meta["n_windows"][split] += 1
+    finally:
+        for split in SPLITS:
+            for writer in writers[split]:
+                writer.close()
+
+    with open(os.path.join(tmp, SHARD_META), 'w') as file:
+        json.dump(meta, file)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp, out_dir)
+    return meta
+
+
+def read_shard_meta(shard_dir):
+    """meta data written by export_shards(), None if shard_dir holds no (complete) export"""
+    path = os.path.join(shard_dir, SHARD_META)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def shard_dataset(shard_dir, split, batch_size, shuffle=True, shuffle_buffer=10000, cycle_length=8, drop_remainder=False):
+    """
+    tf.data pipeline of float32 (inp, tar) batches streamed from the shards of 'split' ("train" or "val") written by
+    export_shards(). 'cycle_length' shards are read in parallel and interleaved, the records are shuffled in a buffer of
+    'shuffle_buffer' windows and decoded a batch at a time, so memory does not depend on the size of the corpus.
+    """
+    meta = read_shard_meta(shard_dir)
+    if meta is None:
+        raise Exception(f"Got no shards in {shard_dir}")
+    inp_shape, tar_shape, dtype = meta["inp_shape"], meta["tar_shape"], tf.as_dtype(meta["dtype"])
+    features = {"inp": tf.io.FixedLenFeature([], tf.string), "tar": tf.io.FixedLenFeature([], tf.string)}
+
+    def parse(records):
+        ex = tf.io.parse_example(records, features)
+        inp = tf.reshape(tf.io.decode_raw(ex["inp"], dtype), [-1] + inp_shape)     #(batch_size, seq_len, n_feat_inp)
+        tar = tf.reshape(tf.io.decode_raw(ex["tar"], dtype), [-1] + tar_shape)
+        return tf.cast(inp, tf.float32), tf.cast(tar, tf.float32)
+
+    files = tf.data.Dataset.list_files(os.path.join(shard_dir, split, "*.tfrecord"), shuffle=shuffle)
+    ds = files.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=meta["compression"]),
+                          cycle_length=min(cycle_length, meta["n_shards"]), num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=not shuffle)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer)
+    return ds.batch(batch_size, drop_remainder=drop_remainder).map(parse, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
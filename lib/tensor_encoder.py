@@ -1,9 +1,11 @@
 
+import functools
 import numpy as np
+import pandas as pd
 import time
 import tensorflow as tf
 #from sklego.preprocessing import RepeatingBasisFunction
-from .field_info import FieldInfo  # Assuming you named the other file as field_info.py
+from .field_info import FieldInfo, field_layouts  # Assuming you named the other file as field_info.py
 import random
 import os
 
@@ -12,21 +14,28 @@ import os
 # tf.random.set_seed(0)
 # os.environ['TF_DETERMINISTIC_OPS'] = '1'
 
+# bump when the encoded tensors change, invalidates entries of lib.data_cache.load_encoded()
+ENCODER_VERSION = 1
+
 
 class TensorEncoder:
-    def __init__(self, df, info, max_seq_len, min_seq_len):
-        """df: preprocessed real data   """
+    def __init__(self, df, info, max_seq_len, min_seq_len, dtype=np.float32):
+        """df: preprocessed real data
+           dtype: dtype of inp_tensor and tar_tensor, float32 (what the models consume) or float16 to halve storage.
+                  The category codes ('*_num' fields, stored as they are for 'emb_*' inputs, raw targets and raw=True)
+                  must be exact in it, float16 holds integers up to 2048 only"""
         self.df = df
         self.info = info
+        self.dtype = dtype
         self.max_seq_len = max_seq_len
         self.min_seq_len = min_seq_len
+        self.check_code_range()
         
-        self.n_seqs = self.count_seqs_in_df()   #14354
-        self.n_seqs_overlap = self.count_seqs_with_overlap()    #72764
-        self.n_seqs_overlap_vary = self.count_variable_length_seqs_with_overlap()   #99101
+        self.build_account_index()
 
-        self.n_feat_inp = sum(self.info.FIELD_DIMS_IN.values())      #number of features
-        self.n_feat_tar = sum(self.info.FIELD_DIMS_TAR.values())
+        self.layouts = field_layouts(self.info)
+        self.n_feat_inp = self.layouts["IN"].width      #number of features
+        self.n_feat_tar = self.layouts["TAR"].width
 
         # rbf_dow = RepeatingBasisFunction(n_periods=3, column="dow", input_range=(0,6), remainder="drop")
         # rbf_day = RepeatingBasisFunction(n_periods=3, column="day", input_range=(0,30), remainder="drop")
@@ -41,57 +50,86 @@ class TensorEncoder:
         # self.rbf_dict = {'dow': rbf_dow, 'day': rbf_day, 'dtme' : rbf_dtme, 'month':rbf_month}
        
 
+    def check_code_range(self):
+        """raises if a category code or embedding vocabulary of the field info does not fit exactly in self.dtype, the
+           stored indices would be rounded and look up the wrong rows/classes without any error"""
+        if not np.issubdtype(self.dtype, np.floating):
+            return
+        limit = 2 ** (np.finfo(self.dtype).nmant + 1)
+        for k in self.info.DATA_KEY_ORDER:
+            vocab = getattr(self.info, "EMBEDDINGS", {}).get(k, (0,))[0]
+            if "_num" in k and len(self.df) and max(int(self.df[k].max()) + 1, vocab) > limit:
+                raise Exception(f"Got invalid dtype {np.dtype(self.dtype).name} for field {k}: its codes do not fit exactly "
+                                f"(at most {limit}), use float32")
+
+    def build_account_index(self):
+        """sorts the rows by account once (stable, so the order of the transactions of an account is kept) and stores the
+           (offset, length) of every account in the sorted rows, accounts are in increasing account_id order"""
+        acct = self.df["account_id"].to_numpy()
+        if len(acct) > 1 and not np.all(acct[:-1] <= acct[1:]):
+            self.rows = self.df.iloc[np.argsort(acct, kind="stable")]
+            acct = self.rows["account_id"].to_numpy()
+        else:
+            self.rows = self.df
+        self.account_ids, self.acct_offsets, self.acct_lengths = np.unique(acct, return_index=True, return_counts=True)
+
+    def accounts_by_count(self):
+        """positions of the accounts in the index, ordered as df['account_id'].value_counts()"""
+        return np.searchsorted(self.account_ids, self.df['account_id'].value_counts().index.to_numpy())
+
+    def window_counts(self, mode, slide_step=10, accounts=None):
+        """number of sequences of every account (all of them or the positions 'accounts'), mode is
+              'disjoint': sequences do not overlap, as in encode()
+              'overlap': windows of length max_seq_len every slide_step transactions, as in encode_with_overlap()
+              'variable': as 'overlap', followed by shorter windows down to min_seq_len, as in encode_variable_length_with_overlap() """
+        n = self.acct_lengths if accounts is None else self.acct_lengths[accounts]
+        if mode == "disjoint":
+            return n // self.max_seq_len + (n % self.max_seq_len >= self.min_seq_len)
+        n_full = np.maximum((n - self.max_seq_len) // slide_step + 1, 0)
+        if mode == "overlap":
+            return n_full
+        if mode == "variable":
+            return n_full + np.maximum((n - self.min_seq_len - n_full * slide_step) // slide_step + 1, 0)
+        raise Exception(f"Got invalid mode: {mode}")
+
+    def window_table(self, mode, slide_step=10):
+        """start (position in self.rows), length and account position of every sequence, in encoding order
+           (accounts in increasing account_id order for 'disjoint', in value_counts() order otherwise)"""
+        accounts = np.arange(len(self.account_ids)) if mode == "disjoint" else self.accounts_by_count()
+        if mode == "disjoint":
+            slide_step = self.max_seq_len
+        k = self.window_counts(mode, slide_step, accounts)
+        seq_acct = np.repeat(accounts, k)
+        local_start = (np.arange(k.sum()) - np.repeat(np.cumsum(k) - k, k)) * slide_step
+        lengths = np.minimum(self.max_seq_len, self.acct_lengths[seq_acct] - local_start)
+        return self.acct_offsets[seq_acct] + local_start, lengths, seq_acct
+
+    @functools.cached_property
+    def n_seqs(self):
+        return int(self.count_seqs_in_df())
+
+    @functools.cached_property
+    def n_seqs_overlap(self):
+        return int(self.count_seqs_with_overlap())
+
+    @functools.cached_property
+    def n_seqs_overlap_vary(self):
+        return int(self.count_variable_length_seqs_with_overlap())
+
     def count_seqs_in_df(self):
         """sequences do not have overlap, the length of sequences are between 'min_seq_len' and 'max_seq_len' """
-        gb_aid = self.df.groupby("account_id")["account_id"]
-        full_seqs_per_acct = gb_aid.count() // self.max_seq_len
-        n_full_seqs = sum(full_seqs_per_acct)
-        n_part_seqs = sum(gb_aid.count() - full_seqs_per_acct * self.max_seq_len >= self.min_seq_len)
-        return n_full_seqs + n_part_seqs  #14354
+        return self.window_counts("disjoint").sum()
     
     
     def count_seqs_with_overlap(self,  slide_step = 10):
         """Count sequences in dataset with overlap using a sliding window.
             sequences are of fixed length=max_seq_len"""
-        
-        total_seqs = 0
-        # Unique account IDs
-        valid_ids = self.df['account_id'].value_counts().index.tolist()
-
-        for acc_id in valid_ids:
-            acc_data_len = len(self.df[self.df['account_id'] == acc_id])
-            
-           
-            num_seqs_for_this_id = (acc_data_len - self.max_seq_len) // slide_step + 1
-
-            if num_seqs_for_this_id > 0:
-                total_seqs += num_seqs_for_this_id
-
-        return total_seqs      #72764
+        return self.window_counts("overlap", slide_step).sum()
     
     def count_variable_length_seqs_with_overlap(self, slide_step = 10):
         """Count sequences in dataset with overlap using a sliding window for variable sequence lengths, but
          the sequence length are greater than minimum sequence length"""
-        
-        # The number of sequences will be stored in this variable
-        total_seqs = 0
-        
-        # Unique account IDs
-        valid_ids = self.df['account_id'].value_counts().index.tolist()
-
-        for acc_id in valid_ids:
-            acc_data_len = len(self.df[self.df['account_id'] == acc_id])
-            
-            start_idx = 0
-            while start_idx + self.max_seq_len <= acc_data_len:
-                total_seqs += 1
-                start_idx += slide_step
-
-            while acc_data_len - start_idx >= self.min_seq_len:
-                total_seqs += 1
-                start_idx += slide_step
-
-        return total_seqs       #99101
+        return self.window_counts("variable", slide_step).sum()
     
     @staticmethod
     def bulk_encode_time_value(val, max_val):
@@ -99,147 +137,167 @@ class TensorEncoder:
         y = np.cos(2 * np.pi / max_val * val)
         return np.stack([x, y], axis=1)
 
-    def seq_to_inp_tensor(self, seq, seq_i, seq_len):
-        """seq is group.iloc[start:start+seq_len], group is df.groupby('account_id')"""
-        for k in self.info.DATA_KEY_ORDER:
-            depth = self.info.FIELD_DIMS_IN[k]
-            st = self.info.FIELD_STARTS_IN[k]
-            enc_type = self.info.INP_ENCODINGS[k]
-            #if enc_type == "oh_tcode":
-            if enc_type.startswith('oh'):
-                x = tf.one_hot(seq[k], depth).numpy()
-            elif enc_type == "cl":
-                max_val = self.info.CLOCK_DIMS[k]
-                x = self.bulk_encode_time_value(seq[k], max_val)
-                #print(x.shape)
-            elif enc_type == "rbf":
-                x = self.rbf_dict[k].transform(seq)
-                #print(x.shape)
-            elif enc_type == "raw":
-                x = np.expand_dims(seq[k], 1)
-            else:
-                raise Exception(f"Got invalid enc_type: {enc_type}")
-            self.inp_tensor[seq_i, :seq_len, st:st + depth] = x
+    @staticmethod
+    def one_hot(codes, depth, dtype=np.float32):
+        """one-hot rows of the integer array 'codes', codes outside [0, depth) give zero rows like tf.one_hot"""
+        codes = np.asarray(codes, dtype=np.int64)
+        x = np.zeros((len(codes), depth), dtype=dtype)
+        valid = (codes >= 0) & (codes < depth)
+        x[np.flatnonzero(valid), codes[valid]] = 1
+        return x
 
-    def seq_to_targ_tensor(self, seq, seq_i, seq_len):
-   
-        for k in self.info.DATA_KEY_ORDER:
-            depth = self.info.FIELD_DIMS_TAR[k]
-            st = self.info.FIELD_STARTS_TAR[k]
-            enc_type = self.info.TAR_ENCODINGS[k]
-            if enc_type == "cl-i":
-                #max_val = self.info.CLOCK_DIMS[k]
-                #x = np.expand_dims(seq[k] % max_val, 1)
-                x = np.expand_dims(seq[k], 1)
-            elif enc_type == "raw":
-                x = np.expand_dims(seq[k], 1)
+    def transaction_features(self, target=False):
+        """encodes every transaction of self.rows once, returns an array of shape (n_rows, n_feat_inp), or
+           (n_rows, n_feat_tar) with the target encodings if target=True"""
+        layout = self.layouts["TAR" if target else "IN"]
+        encodings = self.info.TAR_ENCODINGS if target else self.info.INP_ENCODINGS
+        feats = np.zeros((len(self.rows), layout.width), dtype=self.dtype)
+        for k, depth in zip(layout.order, layout.dims):
+            enc_type = encodings[k]
+            values = self.rows[k].to_numpy()
+            if not target and enc_type.startswith('oh'):
+                x = self.one_hot(values, depth, self.dtype)
             elif enc_type == "cl":
                 max_val = self.info.CLOCK_DIMS[k]
-                x = self.bulk_encode_time_value(seq[k], max_val)
+                x = self.bulk_encode_time_value(values, max_val)
+            elif not target and enc_type == "rbf":
+                x = self.rbf_dict[k].transform(self.rows)
+            elif enc_type == "raw" or (target and enc_type == "cl-i") or (not target and enc_type.startswith('emb')):
+                x = np.expand_dims(values, 1)
             else:
                 raise Exception(f"Got invalid enc_type: {enc_type}")
-            self.tar_tensor[seq_i, :seq_len, st:st + depth] = x
+            feats[:, layout.slices[k]] = x
+        return feats
 
+    def raw_features(self):
+        """the columns DATA_KEY_ORDER of every transaction of self.rows, shape (n_rows, n_fields), encoded in the graph
+           by lib.modules.FeatureEncoding"""
+        return self.rows[list(self.info.DATA_KEY_ORDER)].to_numpy(dtype=self.dtype)
 
-    def encode(self, add_attribute_row = True):
-        """Compatible with count_seqs_in_df() """
-        self.inp_tensor = np.zeros((self.n_seqs, self.max_seq_len, self.n_feat_inp))
-        self.tar_tensor = np.zeros((self.n_seqs, self.max_seq_len, self.n_feat_tar))
-        self.attributes = np.zeros(self.n_seqs)
-        seq_i = 0
-        rows_per_acct = {}
-        alert_every = 2000
+    def gather_windows(self, feats, starts, lengths, block_size=8192):
+        """tensor of shape (n_seqs, max_seq_len, n_feat), sequence i is feats[starts[i]:starts[i] + lengths[i]] zero padded
+           to max_seq_len, windows are gathered 'block_size' at a time to bound the temporary index arrays"""
+        out = np.zeros((len(starts), self.max_seq_len, feats.shape[1]), dtype=self.dtype)
+        pos = np.arange(self.max_seq_len)
+        for b in range(0, len(starts), block_size):
+            idx = starts[b:b + block_size, None] + pos                 #(block_size, max_seq_len) rows of feats
+            mask = pos < lengths[b:b + block_size, None]
+            out[b:b + block_size][mask] = feats[idx[mask]]
+        return out
+
+    def encode_windows(self, mode, slide_step=10, add_attribute_row = True, lazy=False, raw=False):
+        """encodes every sequence of window_table(mode, slide_step) into inp_tensor, tar_tensor and attributes
+           lazy: only encode the transactions (inp_flat, tar_flat) and keep the window table (window_starts, window_lengths),
+                 the sequences are gathered on the fly by window_batches(), memory scales with the number of transactions
+           raw: store the raw columns of the sequences in raw_tensor (n_seqs, max_seq_len, n_fields) and their lengths in
+                window_lengths instead of inp_tensor/tar_tensor, they are encoded in the graph by lib.modules.FeatureEncoding"""
         start_time = time.time()
-        for acct_id, group in self.df.groupby("account_id"):
-            rows_per_acct[acct_id] = []
-            for i in range(len(group) // self.max_seq_len + 1):
-                n_trs = len(group)
-                start = i * self.max_seq_len
-                seq_len = min(self.max_seq_len, n_trs - start)
-                if seq_len >= self.min_seq_len:
-                    self.seq_to_inp_tensor(group.iloc[start:start + seq_len], seq_i, seq_len)
-                    self.seq_to_targ_tensor(group.iloc[start:start + seq_len], seq_i, seq_len)
-                    self.attributes[seq_i] = group["age_sc"].iloc[0]
-                    rows_per_acct[acct_id].append(seq_i)
-                    seq_i += 1
-                    if seq_i % alert_every == 0:
-                        print(f"Finished encoding {seq_i} of {self.n_seqs} seqs")
+        starts, lengths, seq_acct = self.window_table(mode, slide_step)
+        # attribute of a sequence is the age of the first transaction of its account
+        self.attributes = self.rows["age_sc"].to_numpy()[self.acct_offsets[seq_acct]].astype(np.float64)
+        self.add_attribute_row = add_attribute_row
+        self.lazy = lazy
+        self.raw = raw
+        if raw:
+            if lazy:
+                raise Exception("Got lazy=True and raw=True, only one of them can be used")
+            self.raw_tensor = self.gather_windows(self.raw_features(), starts, lengths)
+            self.window_lengths = lengths
+            print(f"Took {time.time() - start_time:.2f} secs")
+            return
+        if lazy:
+            # max_seq_len zero rows at the end, so every window can be gathered without going out of bounds
+            padding = np.zeros((self.max_seq_len, 1), dtype=self.dtype)
+            self.inp_flat = np.concatenate([self.transaction_features(), np.repeat(padding, self.n_feat_inp, axis=1)])
+            self.tar_flat = np.concatenate([self.transaction_features(target=True), np.repeat(padding, self.n_feat_tar, axis=1)])
+            self.window_starts, self.window_lengths = starts, lengths
+            print(f"Took {time.time() - start_time:.2f} secs")
+            return
+        self.inp_tensor = self.gather_windows(self.transaction_features(), starts, lengths)
+        self.tar_tensor = self.gather_windows(self.transaction_features(target=True), starts, lengths)
         if add_attribute_row:
-            self.inp_tensor = np.concatenate([np.repeat(self.attributes[:, None, None], self.n_feat_inp, axis=2), self.inp_tensor], axis=1)
+            self.inp_tensor = np.concatenate([np.repeat(self.attributes[:, None, None].astype(self.dtype), self.n_feat_inp, axis=2), self.inp_tensor], axis=1)
             
         print(f"Took {time.time() - start_time:.2f} secs")
 
-    def encode_with_overlap(self, slide_step=10, add_attribute_row = True):
-        """compatible with function count_seqs_with_overlap() """
-        self.n_seqs_overlap = self.count_seqs_with_overlap(slide_step)
-        self.inp_tensor = np.zeros((self.n_seqs_overlap, self.max_seq_len, self.n_feat_inp))
-        self.tar_tensor = np.zeros((self.n_seqs_overlap, self.max_seq_len, self.n_feat_tar))
-        self.attributes = np.zeros(self.n_seqs_overlap)
-        seq_i = 0
-        rows_per_acct = {}
-        alert_every = 2000
-        start_time = time.time()
-        valid_ids = self.df['account_id'].value_counts().index.tolist()
+    def encode(self, add_attribute_row = True, lazy=False, raw=False):
+        """Compatible with count_seqs_in_df() """
+        self.encode_windows("disjoint", add_attribute_row=add_attribute_row, lazy=lazy, raw=raw)
 
-        for acc_id in valid_ids:
-            group = self.df[self.df['account_id'] == acc_id]
-            rows_per_acct[acc_id] = []
-            acc_data_len = len(group)
-            
-            for start_idx in range(0, acc_data_len - self.max_seq_len + 1, slide_step):
-                self.seq_to_inp_tensor(group.iloc[start_idx:start_idx + self.max_seq_len], seq_i, self.max_seq_len)
-                self.seq_to_targ_tensor(group.iloc[start_idx:start_idx + self.max_seq_len], seq_i, self.max_seq_len)
-                self.attributes[seq_i] = group["age_sc"].iloc[0]
-                rows_per_acct[acc_id].append(seq_i)
-                seq_i += 1
-                if seq_i % alert_every == 0:
-                    print(f"Finished encoding {seq_i} of {self.n_seqs_overlap} seqs")
-        if add_attribute_row:
-            self.inp_tensor = np.concatenate([np.repeat(self.attributes[:, None, None], self.n_feat_inp, axis=2), self.inp_tensor], axis=1)
-            
-        print(f"Took {time.time() - start_time:.2f} secs")
+    def encode_with_overlap(self, slide_step=10, add_attribute_row = True, lazy=False, raw=False):
+        """compatible with function count_seqs_with_overlap() """
+        self.n_seqs_overlap = int(self.count_seqs_with_overlap(slide_step))
+        self.encode_windows("overlap", slide_step, add_attribute_row, lazy, raw)
     
-    def encode_variable_length_with_overlap(self, slide_step=40,  add_attribute_row = True):
+    def encode_variable_length_with_overlap(self, slide_step=40,  add_attribute_row = True, lazy=False, raw=False):
         """compatible with the function count_variable_length_seqs_with_overlap() """
-        self.inp_tensor = np.zeros((self.n_seqs_overlap_vary, self.max_seq_len, self.n_feat_inp))
-        self.tar_tensor = np.zeros((self.n_seqs_overlap_vary, self.max_seq_len, self.n_feat_tar))
-        self.attributes = np.zeros( self.n_seqs_overlap_vary )
+        self.n_seqs_overlap_vary = int(self.count_variable_length_seqs_with_overlap(slide_step))
+        self.encode_windows("variable", slide_step, add_attribute_row, lazy, raw)
 
-        seq_i = 0
-        rows_per_acct = {}
-        alert_every = 2000
+    def windows(self, indices):
+        """(inp, tar) arrays of the windows 'indices', the same rows as inp_tensor/tar_tensor, for both the dense and the lazy encoding"""
+        indices = np.asarray(indices)
+        if self.raw:
+            raise Exception("Got an encoder run with raw=True, its windows are encoded by lib.modules.FeatureEncoding")
+        if not self.lazy:
+            return self.inp_tensor[indices], self.tar_tensor[indices]
+        starts, lengths = self.window_starts[indices], self.window_lengths[indices]
+        inp = self.gather_windows(self.inp_flat, starts, lengths)
+        tar = self.gather_windows(self.tar_flat, starts, lengths)
+        if self.add_attribute_row:
+            inp = np.concatenate([np.repeat(self.attributes[indices, None, None].astype(self.dtype), self.n_feat_inp, axis=2), inp], axis=1)
+        return inp, tar
 
-        valid_ids = self.df['account_id'].value_counts().index.tolist()
+    def window_batches(self, indices, batch_size, shuffle=True, drop_remainder=False):
+        """
+        tf.data pipeline of (inp, tar) batches of the windows 'indices' of an encoder run with lazy=True.
+        Only the window table is shuffled and batched, the batches are gathered from inp_flat/tar_flat in a map, so the
+        elements are the same as the rows of inp_tensor/tar_tensor of the dense encoding.
+        """
+        pos = tf.range(self.max_seq_len)
+        inp_flat = tf.constant(self.inp_flat)
+        tar_flat = tf.constant(self.tar_flat)
+        n_feat_inp = self.n_feat_inp
+        add_attribute_row = self.add_attribute_row
 
-        for acc_id in valid_ids:
-            group = self.df[self.df['account_id'] == acc_id]
-            rows_per_acct[acc_id] = []
-            acc_data_len = len(group)
-            
-            start_idx = 0
-            while start_idx + self.max_seq_len <= acc_data_len:
-                self.seq_to_inp_tensor(group.iloc[start_idx:start_idx + self.max_seq_len], seq_i, self.max_seq_len)
-                self.seq_to_targ_tensor(group.iloc[start_idx:start_idx + self.max_seq_len], seq_i, self.max_seq_len)
-                self.attributes[seq_i] = group["age_sc"].iloc[0]
-                rows_per_acct[acc_id].append(seq_i)
-                seq_i += 1
-                if seq_i % alert_every == 0:
-                    print(f"Finished encoding {seq_i} of {self.n_seqs} seqs")
-                start_idx += slide_step
+        def gather(start, length, attribute):
+            idx = start[:, None] + pos                                      #(batch_size, max_seq_len)
+            mask = (pos[None, :] < length[:, None])[:, :, None]
+            inp = tf.where(mask, tf.cast(tf.gather(inp_flat, idx), tf.float32), 0.)
+            tar = tf.where(mask, tf.cast(tf.gather(tar_flat, idx), tf.float32), 0.)
+            if add_attribute_row:
+                inp = tf.concat([tf.tile(attribute[:, None, None], [1, 1, n_feat_inp]), inp], axis=1)
+            return inp, tar
 
-            
-            while acc_data_len - start_idx >= self.min_seq_len:
-                seq_len = min(self.max_seq_len, acc_data_len - start_idx)
-                self.seq_to_inp_tensor(group.iloc[start_idx:], seq_i, seq_len)
-                self.seq_to_targ_tensor(group.iloc[start_idx:], seq_i, seq_len)
-                self.attributes[seq_i] = group["age_sc"].iloc[0]
-                rows_per_acct[acc_id].append(seq_i)
-                seq_i += 1
-                if seq_i % alert_every == 0:
-                    print(f"Finished encoding {seq_i} of {self.n_seqs_overlap_vary} seqs")
-                start_idx += slide_step
-        if add_attribute_row:
-            self.inp_tensor = np.concatenate([np.repeat(self.attributes[:, None, None], self.n_feat_inp, axis=2), self.inp_tensor], axis=1)
-            
+        indices = np.asarray(indices)
+        ds = tf.data.Dataset.from_tensor_slices((self.window_starts[indices].astype(np.int32), self.window_lengths[indices].astype(np.int32),
+                                                 self.attributes[indices].astype(self.dtype).astype(np.float32)))
+        if shuffle:
+            ds = ds.shuffle(len(indices))
+        return ds.batch(batch_size, drop_remainder=drop_remainder).map(gather, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+def encode_chunks(chunks, info, max_seq_len, min_seq_len, method="encode", **kwargs):
+    """
+    Encodes preprocessed chunks (e.g. from preprocess_data_czech_chunked()) without holding the whole frame in memory.
+    The rows of the last account of every chunk are held back and prepended to the next chunk, so all transactions of an
+    account are encoded together. The rows of an account have to be contiguous in the csv, as in tr_by_acct_w_age.csv.
 
-   
\ No newline at end of file
+    Yields a TensorEncoder for every run of complete accounts, after calling its 'method' (encode, encode_with_overlap or
+    encode_variable_length_with_overlap) with kwargs. Its inp_tensor, tar_tensor and attributes can be written out or
+    concatenated.
+    """
+    tail = None
+    for df in chunks:
+        if tail is not None:
+            df = pd.concat([tail, df], ignore_index=True)
+        is_tail = (df["account_id"] == df["account_id"].iloc[-1]).to_numpy()
+        tail, df = df[is_tail], df[~is_tail]
+        if len(df):
+            encoder = TensorEncoder(df, info, max_seq_len, min_seq_len)
+            getattr(encoder, method)(**kwargs)
+            yield encoder
+    if tail is not None and len(tail):
+        encoder = TensorEncoder(tail, info, max_seq_len, min_seq_len)
+        getattr(encoder, method)(**kwargs)
+        yield encoder
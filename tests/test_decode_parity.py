@@ -0,0 +1,62 @@
+"""
+Parity of the incremental generation paths with the full-prefix forward passes they replace, on small random models.
+Run with `python -m pytest tests` or `python -m tests.test_decode_parity` from the repository root.
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import tensorflow as tf
+from lib.benchmarks import check_kv_cache_parity, check_lstm_step_parity
+from lib.field_info import FieldInfo
+from lib.modules import Transformer, Encoder_Decoder_lstm_Inference
+
+N_SEQS, SEQ_LEN = 4, 12
+
+
+def model_config(info):
+    return {"ORDER": info.DATA_KEY_ORDER, "FIELD_STARTS_IN": info.FIELD_STARTS_IN, "FIELD_DIMS_IN": info.FIELD_DIMS_IN,
+            "FIELD_STARTS_NET": info.FIELD_STARTS_NET, "FIELD_DIMS_NET": info.FIELD_DIMS_NET,
+            "ACTIVATIONS": info.ACTIVATIONS, "EMBEDDINGS": info.EMBEDDINGS}
+
+
+def random_inputs(n_feat_inp, seed=0):
+    return np.random.default_rng(seed).normal(size=(N_SEQS, SEQ_LEN, n_feat_inp)).astype(np.float32)
+
+
+def small_transformer():
+    tf.random.set_seed(0)
+    info = FieldInfo('banksformer')
+    n_feat_inp = sum(info.FIELD_DIMS_IN.values())
+    transformer = Transformer(n_feat_inp, 32, 16, 16, 64, 2, 2, model_config(info), rate=0.1)
+    inp = random_inputs(n_feat_inp)
+    transformer(inp, inp[:, 1:])        # build
+    return transformer, inp
+
+
+def test_kv_cache_parity():
+    transformer, inp = small_transformer()
+    check_kv_cache_parity(transformer, inp)
+
+
+def test_kv_cache_parity_compiled():
+    transformer, inp = small_transformer()
+    check_kv_cache_parity(transformer, inp, compiled=True)
+
+
+def test_lstm_step_parity():
+    tf.random.set_seed(0)
+    info = FieldInfo('banksformer')
+    n_feat_inp = sum(info.FIELD_DIMS_IN.values())
+    lstm = Encoder_Decoder_lstm_Inference(model_config(info), n_feat_inp, True, unit=16)
+    inp = random_inputs(n_feat_inp)
+    lstm(inp)       # build
+    check_lstm_step_parity(lstm, inp)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")